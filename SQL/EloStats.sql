@@ -1,33 +1,112 @@
-with `c` as (
-	with `a` as (
-		select 	`elo`.`end_time` AS `end_time`,
-				(sum(`elo`.`elo_rating`) / count(`elo`.`elo_rating`)) AS `average_elo`,
-				(SELECT `minutes` FROM `constants` ORDER BY `idconstants` DESC LIMIT 1) AS `minutes`,
-				(SELECT `standard_deviations` FROM `constants` ORDER BY `idconstants` DESC LIMIT 1) AS `standard_deviations`
-	from `elo`
-    group by `elo`.`end_time`
-    )
-select 	`b`.`idelo` AS `idelo`,
-		`b`.`coin` AS `coin`,
-        `b`.`start_time` AS `start_time`,
-        `b`.`elo_rating` AS `elo_rating`,
-        `b`.`end_time` AS `end_time`,
-        `a`.`average_elo` AS `average_elo`,
-        `a`.`standard_deviations` AS `standard_deviations`,
-        sqrt((sum(pow((`b`.`elo_rating` - `a`.`average_elo`),2)) / count(`b`.`end_time`))) AS `std_dev`
-from (`elo` `b` join `a` on((`a`.`end_time` = `b`.`end_time`)))
-group by `b`.`end_time`
-)
-
-select 	`d`.`idelo` AS `idelo`,
-		`d`.`coin` AS `coin`,
-        `d`.`start_time` AS `start_time`,
-        `d`.`elo_rating` AS `elo_rating`,
-        `d`.`end_time` AS `end_time`,
-        `c`.`average_elo` AS `average_elo`,
-        `c`.`std_dev` AS `std_dev`,
-(`c`.`average_elo` - (`c`.`standard_deviations` * `c`.`std_dev`)) AS `lower_limit`,
-(`c`.`average_elo` + (`c`.`standard_deviations` * `c`.`std_dev`)) AS `upper_limit`
-from (`c` join `elo` `d` on((`c`.`end_time` = `d`.`end_time`)))
-where `c`.`end_time` = (select `end_time` from `elo` order by `end_time` desc limit 1)
-order by `d`.`idelo` desc
\ No newline at end of file
+-- Materialized Elo statistics, one row per coin and interval. Each row holds
+-- the coin's rating along with the average and standard deviation of all
+-- ratings in the interval, the limits at `standard_deviations` either side of
+-- the average and the coin's average rating over the last `moving_average_n`
+-- intervals (both from the latest `constants` row). Rows of an interval are
+-- written by spRefreshEloStats when that interval is inserted into `elo`, so
+-- reading them is an index lookup rather than an aggregation over `elo`
+
+DROP VIEW IF EXISTS `crypto_db`.`elo_stats`;
+
+CREATE TABLE IF NOT EXISTS `crypto_db`.`elo_stats` (
+  `coin` VARCHAR(45) NOT NULL,
+  `start_time` BIGINT NOT NULL,
+  `elo_rating` DOUBLE NOT NULL,
+  `end_time` BIGINT NOT NULL,
+  `average_elo` DOUBLE NOT NULL,
+  `std_dev` DOUBLE NOT NULL,
+  `lower_limit` DOUBLE NOT NULL,
+  `upper_limit` DOUBLE NOT NULL,
+  `moving_average` DOUBLE NOT NULL,
+  PRIMARY KEY (`end_time`, `coin`),
+  KEY `ix_elo_stats_coin_end_time` (`coin`, `end_time`)
+);
+
+-- Needed to find the intervals of the moving average window
+ALTER TABLE `crypto_db`.`elo` ADD KEY `ix_elo_end_time` (`end_time`);
+
+DELIMITER $$
+
+DROP PROCEDURE IF EXISTS `crypto_db`.`spRefreshEloStats`$$
+
+CREATE PROCEDURE `crypto_db`.`spRefreshEloStats`(IN `p_end_time` BIGINT)
+BEGIN
+  DECLARE `v_average_elo` DOUBLE;
+  DECLARE `v_std_dev` DOUBLE;
+  DECLARE `v_standard_deviations` DOUBLE;
+  DECLARE `v_moving_average_n` INT;
+  DECLARE `v_window_start` BIGINT;
+
+  SELECT `standard_deviations`, `moving_average_n`
+  INTO `v_standard_deviations`, `v_moving_average_n`
+  FROM `crypto_db`.`constants`
+  ORDER BY `idconstants` DESC
+  LIMIT 1;
+
+  SELECT AVG(`elo_rating`), STDDEV_POP(`elo_rating`)
+  INTO `v_average_elo`, `v_std_dev`
+  FROM `crypto_db`.`elo`
+  WHERE `end_time` = `p_end_time`;
+
+  -- End time of the oldest interval in the moving average window
+  SELECT MIN(`w`.`end_time`)
+  INTO `v_window_start`
+  FROM (
+    SELECT DISTINCT `end_time`
+    FROM `crypto_db`.`elo`
+    WHERE `end_time` <= `p_end_time`
+    ORDER BY `end_time` DESC
+    LIMIT `v_moving_average_n`
+  ) `w`;
+
+  DELETE FROM `crypto_db`.`elo_stats` WHERE `end_time` = `p_end_time`;
+
+  INSERT INTO `crypto_db`.`elo_stats` (`coin`, `start_time`, `elo_rating`, `end_time`, `average_elo`,
+                                       `std_dev`, `lower_limit`, `upper_limit`, `moving_average`)
+  SELECT `e`.`coin`,
+         `e`.`start_time`,
+         `e`.`elo_rating`,
+         `e`.`end_time`,
+         `v_average_elo`,
+         `v_std_dev`,
+         `v_average_elo` - (`v_standard_deviations` * `v_std_dev`),
+         `v_average_elo` + (`v_standard_deviations` * `v_std_dev`),
+         `m`.`moving_average`
+  FROM `crypto_db`.`elo` `e`
+  JOIN (
+    SELECT `coin`, AVG(`elo_rating`) AS `moving_average`
+    FROM `crypto_db`.`elo`
+    WHERE `end_time` BETWEEN `v_window_start` AND `p_end_time`
+    GROUP BY `coin`
+  ) `m` ON `m`.`coin` = `e`.`coin`
+  WHERE `e`.`end_time` = `p_end_time`;
+END$$
+
+-- Fills `elo_stats` from the whole `elo` table, oldest interval first. Only
+-- needed once when the table is created
+DROP PROCEDURE IF EXISTS `crypto_db`.`spRebuildEloStats`$$
+
+CREATE PROCEDURE `crypto_db`.`spRebuildEloStats`()
+BEGIN
+  DECLARE `v_done` INT DEFAULT 0;
+  DECLARE `v_end_time` BIGINT;
+  DECLARE `c_end_times` CURSOR FOR
+    SELECT DISTINCT `end_time` FROM `crypto_db`.`elo` ORDER BY `end_time`;
+  DECLARE CONTINUE HANDLER FOR NOT FOUND SET `v_done` = 1;
+
+  OPEN `c_end_times`;
+
+  read_loop: LOOP
+    FETCH `c_end_times` INTO `v_end_time`;
+    IF `v_done` = 1 THEN
+      LEAVE read_loop;
+    END IF;
+    CALL `crypto_db`.`spRefreshEloStats`(`v_end_time`);
+  END LOOP;
+
+  CLOSE `c_end_times`;
+END$$
+
+DELIMITER ;
+
+CALL `crypto_db`.`spRebuildEloStats`();
@@ -0,0 +1,107 @@
+-- One row per coin and Elo interval joining the coin's Elo statistics to its
+-- USDT close price, replacing the `price_elo_stats` join. Rows are written by
+-- spRefreshPriceEloFact whenever prices or Elo ratings of an interval arrive,
+-- so regressions read a single (`coin`, `end_time`) range instead of joining
+-- `price_elo_stats` to itself once per lag. Forward returns are not stored,
+-- statistical_analysis.regress_lags derives every lag from the close prices.
+-- Elo intervals end 1ms after the price candles they are matched with, hence
+-- `price`.`end_time` + 1 = `elo`.`end_time`
+
+CREATE TABLE IF NOT EXISTS `crypto_db`.`price_elo_fact` (
+  `coin` VARCHAR(45) NOT NULL,
+  `end_time` BIGINT NOT NULL,
+  `elo_rating` DOUBLE NOT NULL,
+  `moving_average_rating` DOUBLE NOT NULL,
+  `elo_deviation` DOUBLE NULL,
+  `moving_average_deviation` DOUBLE NULL,
+  `close_price` DOUBLE NOT NULL,
+  PRIMARY KEY (`coin`, `end_time`),
+  KEY `ix_price_elo_fact_end_time` (`end_time`)
+);
+
+DELIMITER $$
+
+DROP PROCEDURE IF EXISTS `crypto_db`.`spRefreshPriceEloFact`$$
+
+CREATE PROCEDURE `crypto_db`.`spRefreshPriceEloFact`(IN `p_end_time` BIGINT)
+BEGIN
+  DECLARE `v_moving_average_n` INT;
+  DECLARE `v_window_start` BIGINT;
+
+  SELECT `moving_average_n`
+  INTO `v_moving_average_n`
+  FROM `crypto_db`.`constants`
+  ORDER BY `idconstants` DESC
+  LIMIT 1;
+
+  -- Rows of the interval, only for coins with both an Elo rating and a price
+  INSERT INTO `crypto_db`.`price_elo_fact` (`coin`, `end_time`, `elo_rating`, `moving_average_rating`,
+                                            `elo_deviation`, `close_price`)
+  SELECT `e`.`coin`,
+         `e`.`end_time`,
+         `e`.`elo_rating`,
+         `e`.`moving_average`,
+         (`e`.`elo_rating` - `e`.`average_elo`) / NULLIF(`e`.`std_dev`, 0),
+         `p`.`close_price`
+  FROM `crypto_db`.`elo_stats` `e`
+  JOIN `crypto_db`.`price` `p`
+  ON `p`.`pair` = CONCAT(`e`.`coin`, '-USDT')
+  AND `p`.`end_time` = `p_end_time` - 1
+  WHERE `e`.`end_time` = `p_end_time`
+  ON DUPLICATE KEY UPDATE
+    `elo_rating` = VALUES(`elo_rating`),
+    `moving_average_rating` = VALUES(`moving_average_rating`),
+    `elo_deviation` = VALUES(`elo_deviation`),
+    `close_price` = VALUES(`close_price`);
+
+  -- Trailing average of the deviations over the last moving_average_n
+  -- intervals up to and including this one
+  SELECT MIN(`w`.`end_time`)
+  INTO `v_window_start`
+  FROM (
+    SELECT DISTINCT `end_time`
+    FROM `crypto_db`.`price_elo_fact`
+    WHERE `end_time` <= `p_end_time`
+    ORDER BY `end_time` DESC
+    LIMIT `v_moving_average_n`
+  ) `w`;
+
+  UPDATE `crypto_db`.`price_elo_fact` `f`
+  JOIN (
+    SELECT `coin`, AVG(`elo_deviation`) AS `moving_average_deviation`
+    FROM `crypto_db`.`price_elo_fact`
+    WHERE `end_time` BETWEEN `v_window_start` AND `p_end_time`
+    GROUP BY `coin`
+  ) `m` ON `m`.`coin` = `f`.`coin`
+  SET `f`.`moving_average_deviation` = `m`.`moving_average_deviation`
+  WHERE `f`.`end_time` = `p_end_time`;
+END$$
+
+-- Fills `price_elo_fact` from the whole `elo_stats` table, oldest interval
+-- first. Only needed once when the table is created
+DROP PROCEDURE IF EXISTS `crypto_db`.`spRebuildPriceEloFact`$$
+
+CREATE PROCEDURE `crypto_db`.`spRebuildPriceEloFact`()
+BEGIN
+  DECLARE `v_done` INT DEFAULT 0;
+  DECLARE `v_end_time` BIGINT;
+  DECLARE `c_end_times` CURSOR FOR
+    SELECT DISTINCT `end_time` FROM `crypto_db`.`elo_stats` ORDER BY `end_time`;
+  DECLARE CONTINUE HANDLER FOR NOT FOUND SET `v_done` = 1;
+
+  OPEN `c_end_times`;
+
+  read_loop: LOOP
+    FETCH `c_end_times` INTO `v_end_time`;
+    IF `v_done` = 1 THEN
+      LEAVE read_loop;
+    END IF;
+    CALL `crypto_db`.`spRefreshPriceEloFact`(`v_end_time`);
+  END LOOP;
+
+  CLOSE `c_end_times`;
+END$$
+
+DELIMITER ;
+
+CALL `crypto_db`.`spRebuildPriceEloFact`();
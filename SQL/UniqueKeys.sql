@@ -0,0 +1,35 @@
+-- Unique keys used by the batch endpoints to upsert rows. Existing duplicates
+-- are removed first, keeping the earliest row of each key
+
+DELETE `a` FROM `crypto_db`.`vol_diff` `a`
+JOIN `crypto_db`.`vol_diff` `b`
+ON `a`.`pair` = `b`.`pair`
+AND `a`.`end_time` = `b`.`end_time`
+AND `a`.`idvol_diff` > `b`.`idvol_diff`;
+
+ALTER TABLE `crypto_db`.`vol_diff` ADD UNIQUE KEY `uq_vol_diff_pair_end_time` (`pair`, `end_time`);
+
+DELETE `a` FROM `crypto_db`.`price` `a`
+JOIN `crypto_db`.`price` `b`
+ON `a`.`pair` = `b`.`pair`
+AND `a`.`end_time` = `b`.`end_time`
+AND `a`.`idprice` > `b`.`idprice`;
+
+ALTER TABLE `crypto_db`.`price` ADD UNIQUE KEY `uq_price_pair_end_time` (`pair`, `end_time`);
+
+DELETE `a` FROM `crypto_db`.`elo` `a`
+JOIN `crypto_db`.`elo` `b`
+ON `a`.`coin` = `b`.`coin`
+AND `a`.`end_time` = `b`.`end_time`
+AND `a`.`idelo` > `b`.`idelo`;
+
+ALTER TABLE `crypto_db`.`elo` ADD UNIQUE KEY `uq_elo_coin_end_time` (`coin`, `end_time`);
+
+DELETE `a` FROM `crypto_db`.`statistics` `a`
+JOIN `crypto_db`.`statistics` `b`
+ON `a`.`coin` = `b`.`coin`
+AND `a`.`minutes_forward` = `b`.`minutes_forward`
+AND `a`.`timestamp` = `b`.`timestamp`
+AND `a`.`idstatistics` > `b`.`idstatistics`;
+
+ALTER TABLE `crypto_db`.`statistics` ADD UNIQUE KEY `uq_statistics_coin_minutes_forward_timestamp` (`coin`, `minutes_forward`, `timestamp`);
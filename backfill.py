@@ -0,0 +1,346 @@
+import argparse
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+import simplejson
+from dotenv import load_dotenv
+
+import elo_engine
+import urls as u
+from binanceapi import spot_extended
+from binanceapi.kline_cache import INTERVAL_MILLIS, PAGE_LIMIT
+from binanceapi.rate_limiter import get_request_weight
+from binanceapi.vol_diff_matrix import VolDiffMatrix
+from utilities import atomic_write, log_error
+
+MILLIS_IN_MIN = 1000 * 60
+
+# Binance only accepts aggTrades time ranges of up to an hour, so a vol_diff
+# chunk never spans more than one
+VOL_DIFF_CHUNK_MINUTES = 60
+
+# Elo windows rated and posted per request, each post refreshes the derived
+# tables for every interval it holds
+ELO_POST_WINDOWS = 60
+
+CHECKPOINT_PATH = "Logs/Backfill_Checkpoint.json"
+
+
+def parse_time(value):
+    """ Converts a 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM' UTC time into
+    milliseconds since the epoch """
+    for time_format in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            moment = datetime.datetime.strptime(value, time_format)
+            return int(moment.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError("{0} is not a YYYY-MM-DD [HH:MM] time".format(value))
+
+
+def plan_chunks(kinds, pairs, quote_pair, start_time, end_time, interval_in_minutes):
+    """ Splits the backfill into chunks of one pair and one time range. A price
+    chunk is one page of klines and a vol_diff chunk is one hour of windows, so
+    every chunk costs a small, bounded request weight and can be retried or
+    skipped on resume on its own """
+    interval_millis = MILLIS_IN_MIN * interval_in_minutes
+    # Windows line up with the intervals the live workers use
+    start_time -= start_time % interval_millis
+    chunks = []
+
+    chunk_millis = {
+        'price': interval_millis * PAGE_LIMIT,
+        'vol_diff': interval_millis * max(1, VOL_DIFF_CHUNK_MINUTES // interval_in_minutes)
+    }
+
+    for kind in kinds:
+        # Ratings are computed from the loaded vol_diffs, see backfill_elos
+        if kind == 'elo':
+            continue
+
+        for pair in pairs:
+            if kind == 'price' and pair.split("-")[1].upper() != quote_pair.upper():
+                continue
+
+            for chunk_start_time in range(start_time, end_time, chunk_millis[kind]):
+                chunk_end_time = min(chunk_start_time + chunk_millis[kind], end_time)
+                chunks.append({
+                    "id": "{0}:{1}:{2}:{3}".format(kind, pair, chunk_start_time, chunk_end_time),
+                    "kind": kind,
+                    "pair": pair,
+                    "start_time": chunk_start_time,
+                    "end_time": chunk_end_time
+                })
+
+    return chunks
+
+
+def estimate_weight(chunk, interval_in_minutes):
+    """ Returns the least request weight a chunk costs. Busy pairs need more
+    than one aggTrades page per window """
+    if chunk['kind'] == 'price':
+        return get_request_weight("GET", "/api/v3/klines")
+
+    windows = (chunk['end_time'] - chunk['start_time']) // (MILLIS_IN_MIN * interval_in_minutes)
+    return windows * get_request_weight("GET", "/api/v3/aggTrades")
+
+
+class Checkpoint(object):
+    """ Ids of the chunks already loaded, kept in a JSON file which is
+    rewritten after every chunk so an interrupted backfill resumes where it
+    stopped. The file also records the arguments of the run so it is not
+    resumed with different ones """
+
+    def __init__(self, path, arguments):
+        self.path = path
+        self.arguments = arguments
+        self.lock = threading.Lock()
+        self.completed = set()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                state = json.load(file)
+
+            if state['arguments'] != arguments:
+                raise ValueError("Checkpoint {0} belongs to a backfill with other arguments, "
+                                 "remove it or pass another --checkpoint".format(path))
+
+            self.completed = set(state['completed'])
+
+    def is_completed(self, chunk):
+        return chunk['id'] in self.completed
+
+    def complete(self, chunk):
+        with self.lock:
+            self.completed.add(chunk['id'])
+            with atomic_write(self.path) as file:
+                json.dump({"arguments": self.arguments, "completed": sorted(self.completed)}, file)
+
+
+def fetch_price_chunk(binance_api, chunk, interval):
+    """ Returns the Price endpoint entries of a chunk, read through the kline
+    cache so the klines are also kept on disk """
+    kline = binance_api.kline_cache.get_klines(chunk['pair'].replace("-", ""), interval, chunk['start_time'],
+                                               chunk['end_time'] - 1)
+
+    return [{
+        "pair": chunk['pair'],
+        "start_time": int(candle.open_time),
+        "end_time": int(candle.close_time),
+        "open_price": float(candle.open),
+        "close_price": float(candle.close)
+    } for candle in kline.itertuples(index=False)]
+
+
+def fetch_vol_diff_chunk(binance_api, chunk, interval_in_minutes):
+    """ Returns the VolDiff endpoint entries of a chunk. Raises an exception if
+    a window could not be fetched so the chunk is retried on the next run
+    rather than loaded with a hole in it """
+    interval_millis = MILLIS_IN_MIN * interval_in_minutes
+    vol_diffs = []
+
+    for window_start_time in range(chunk['start_time'], chunk['end_time'], interval_millis):
+        window_end_time = window_start_time + interval_millis
+        result = binance_api.get_vol_diff(chunk['pair'], window_start_time, window_end_time)
+
+        if result is None:
+            raise Exception("Failed to get vol_diff for {0} from {1} to {2}".format(
+                chunk['pair'], window_start_time, window_end_time))
+
+        vol_diffs.append({
+            "pair": chunk['pair'],
+            "start_time": window_start_time,
+            "end_time": window_end_time,
+            "vol_diff": result[0]
+        })
+
+    return vol_diffs
+
+
+def post_batch(url, entries):
+    """ Posts entries to a batch endpoint. The endpoints report errors in
+    the body with a 200 status, so both are checked """
+    response = requests.post(url=url, json=entries)
+    response.raise_for_status()
+
+    body = response.json()
+    if 'error' in body:
+        raise Exception(body['error'])
+
+
+def load_chunk(binance_api, urls, chunk, interval_in_minutes):
+    """ Downloads a chunk and posts it to its batch endpoint in one request.
+    The entries only go to SQL, the local time series store only holds the
+    history the storage_worker collects live (see TimeSeriesStore) """
+    if chunk['kind'] == 'price':
+        entries = fetch_price_chunk(binance_api, chunk, binance_api.get_interval(interval_in_minutes))
+        url = urls.PRICE_BATCH
+    else:
+        entries = fetch_vol_diff_chunk(binance_api, chunk, interval_in_minutes)
+        url = urls.VOL_DIFF_BATCH
+
+    if len(entries) > 0:
+        post_batch(url, entries)
+
+    return len(entries)
+
+
+def backfill(binance_api, urls, chunks, checkpoint, interval_in_minutes, max_workers):
+    """ Loads every chunk not in the checkpoint using up to 'max_workers'
+    threads, all drawing from the client's rate limiter. Returns the number of
+    chunks which failed and are left for the next run """
+    pending = [chunk for chunk in chunks if not checkpoint.is_completed(chunk)]
+    failed = 0
+
+    print("backfill: {0} of {1} chunks to load".format(len(pending), len(chunks)))
+
+    # More threads than pooled connections would just open throwaway connections
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, binance_api.session.pool_size))) as executor:
+        futures = {executor.submit(load_chunk, binance_api, urls, chunk, interval_in_minutes): chunk
+                   for chunk in pending}
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            chunk = futures[future]
+
+            try:
+                entries = future.result()
+                checkpoint.complete(chunk)
+                print("backfill: {0}/{1} {2} ({3} entries)".format(done, len(pending), chunk['id'], entries))
+
+            except Exception as e:
+                log_error(e)
+                print("Error backfilling {0}: {1}".format(chunk['id'], e))
+                failed += 1
+
+    return failed
+
+
+def get_vol_diff_matrix(urls, start_time, end_time):
+    """ Returns the vol_diffs starting at or after 'start_time' and ending at
+    or before 'end_time' as a VolDiffMatrix """
+    response = requests.get(url=urls.VOL_DIFF_MATRIX, params={"start_time": start_time, "end_time": end_time})
+    response.raise_for_status()
+
+    payload = response.json()
+    if 'error' in payload:
+        raise Exception(payload['error'])
+
+    return VolDiffMatrix.from_api(payload)
+
+
+def backfill_elos(urls, start_time, end_time, step_minutes, rater="legacy"):
+    """ Rates the vol_diffs once the backfill is loaded and posts the ratings
+    of the intervals ending between 'start_time' and 'end_time' to the Elo
+    batch endpoint. They are rated as the elo_worker would have rated them
+    live, one window of the last hour every 'step_minutes' (its cycle), see
+    elo_engine.rate_windows. The vol_diffs are read and the ratings posted
+    ELO_POST_WINDOWS windows at a time. Ratings already stored are kept.
+    Returns the number of ratings posted """
+    step_millis = MILLIS_IN_MIN * step_minutes
+    window_end_times = list(range(start_time + step_millis, end_time, step_millis)) + [end_time]
+    count = 0
+
+    for i in range(0, len(window_end_times), ELO_POST_WINDOWS):
+        block_end_times = window_end_times[i:i + ELO_POST_WINDOWS]
+        # The intervals before the block's first window end, up to the end
+        # of the window before it, are already rated
+        previous_end_time = window_end_times[i - 1] if i > 0 else start_time
+
+        matrix = get_vol_diff_matrix(urls, block_end_times[0] - elo_engine.WINDOW_MILLIS, block_end_times[-1])
+        elos = [entry for entry in elo_engine.rate_windows(matrix, block_end_times, rater)
+                if entry['end_time'] > previous_end_time]
+
+        if len(elos) > 0:
+            post_batch(urls.ELO_BATCH, elos)
+            count += len(elos)
+
+        print("backfill: rated windows {0} to {1}".format(block_end_times[0], block_end_times[-1]))
+
+    return count
+
+
+def get_default_pairs(binance_api, urls):
+    """ Returns the pairs the live workers collect, i.e. those between coins
+    with at least the constants table's pairs_per_coin pairs """
+    constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
+    pairs = binance_api.get_pairs()
+
+    return list(binance_api.get_wanted_pairs(binance_api.get_pairs_per_coin(pairs), limit=constants['pairs_per_coin']))
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Backfills the price, vol_diff and elo tables for a past period. "
+                                                 "The local time series store is not backfilled")
+    parser.add_argument("--start", type=parse_time, required=True, help="UTC start, YYYY-MM-DD [HH:MM]")
+    parser.add_argument("--end", type=parse_time, required=True, help="UTC end (exclusive), YYYY-MM-DD [HH:MM]")
+    parser.add_argument("--pairs", nargs="+", help="BASE-QUOTE pairs, defaults to the pairs the workers collect")
+    parser.add_argument("--kinds", nargs="+", choices=["price", "vol_diff", "elo"],
+                        default=["price", "vol_diff", "elo"],
+                        help="elo rates the loaded vol_diffs once every chunk is loaded")
+    parser.add_argument("--interval", type=int, default=1, help="interval in minutes")
+    parser.add_argument("--quote", default="USDT", help="quote asset of the pairs prices are loaded for")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--host", default="", help="host of the API server, defaults to the HOST env var")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without loading anything")
+    args = parser.parse_args()
+
+    if args.end <= args.start:
+        parser.error("--end must be after --start")
+
+    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=os.environ.get("BINANCE_KEY"),
+                                                        secret=os.environ.get("BINANCE_SECRET"))
+
+    if "price" in args.kinds and binance_api.get_interval(args.interval) not in INTERVAL_MILLIS:
+        parser.error("--interval {0} has no kline interval".format(args.interval))
+
+    urls = u.Urls(host=args.host)
+
+    pairs = args.pairs if args.pairs else get_default_pairs(binance_api, urls)
+    chunks = plan_chunks(args.kinds, pairs, args.quote, args.start, args.end, args.interval)
+
+    weight = sum(estimate_weight(chunk, args.interval) for chunk in chunks)
+    print("backfill: {0} chunks over {1} pairs, at least {2} request weight (~{3:.0f} minutes at the rate "
+          "limit)".format(len(chunks), len(pairs), weight, weight / binance_api.rate_limiter.capacity))
+
+    if args.dry_run:
+        return
+
+    checkpoint = Checkpoint(args.checkpoint, {
+        "start": args.start,
+        "end": args.end,
+        "pairs": sorted(pairs),
+        "kinds": sorted(args.kinds),
+        "interval": args.interval,
+        "quote": args.quote
+    })
+
+    failed = backfill(binance_api, urls, chunks, checkpoint, args.interval, args.workers)
+
+    if failed > 0:
+        print("backfill: {0} chunks failed, run again with the same arguments to retry them".format(failed))
+        return
+
+    if "elo" in args.kinds:
+        try:
+            constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
+            count = backfill_elos(urls, args.start, args.end, int(constants['minutes']),
+                                  os.environ.get("ELO_RATER", "legacy"))
+            print("backfill: {0} Elo ratings posted".format(count))
+        except Exception as e:
+            log_error(e)
+            print("Error backfilling Elo ratings: {0}, run again with the same arguments to retry".format(e))
+            return
+
+    print("backfill: complete")
+
+
+if __name__ == '__main__':
+    main()
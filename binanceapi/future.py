@@ -1,4 +1,3 @@
-import requests
 import time
 import hmac
 import hashlib
@@ -6,10 +5,11 @@ from threading import Lock
 from datetime import datetime
 
 from binanceapi.constant import RequestMethod, Interval, OrderSide, OrderStatus, OrderType
+from binanceapi.session import get_session
 
 class FutureClient(object):
 
-    def __init__(self, api_key=None, secret=None, timeout=5, try_counts=5):
+    def __init__(self, api_key=None, secret=None, timeout=5, try_counts=5, pool_size=10):
         self.key = api_key
         self.secret = secret
         self.host = "https://fapi.binance.com"
@@ -18,6 +18,7 @@ class FutureClient(object):
         self.order_count_lock = Lock()
         self.order_count = 1_000_000
         self.try_counts = try_counts
+        self.session = get_session(self.host, pool_size=pool_size)
 
     def build_parameters(self, params: dict):
         keys = list(params.keys())
@@ -36,7 +37,7 @@ class FutureClient(object):
 
         for i in range(0, self.try_counts):
             try:
-                response = requests.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                response = self.session.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
                 if response.status_code == 200:
                     return response.json()
                 else:
@@ -0,0 +1,169 @@
+import datetime
+import os
+import time
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from binanceapi.constant import Interval
+from utilities import atomic_write
+
+KLINE_COLUMNS = ['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_volume', 'trades',
+                 'taker_buy_volume', 'taker_buy_quote_volume']
+
+INTEGER_COLUMNS = ['open_time', 'close_time', 'trades']
+
+MILLIS_IN_MIN = 1000 * 60
+MILLIS_IN_DAY = MILLIS_IN_MIN * 60 * 24
+
+# Interval lengths in milliseconds. Monthly candles have no fixed length and
+# are not cached
+INTERVAL_MILLIS = {
+    Interval.MINUTE_1: MILLIS_IN_MIN,
+    Interval.MINUTE_3: 3 * MILLIS_IN_MIN,
+    Interval.MINUTE_5: 5 * MILLIS_IN_MIN,
+    Interval.MINUTE_15: 15 * MILLIS_IN_MIN,
+    Interval.MINUTE_30: 30 * MILLIS_IN_MIN,
+    Interval.HOUR_1: 60 * MILLIS_IN_MIN,
+    Interval.HOUR_2: 120 * MILLIS_IN_MIN,
+    Interval.HOUR_4: 240 * MILLIS_IN_MIN,
+    Interval.HOUR_6: 360 * MILLIS_IN_MIN,
+    Interval.HOUR_8: 480 * MILLIS_IN_MIN,
+    Interval.HOUR_12: 720 * MILLIS_IN_MIN,
+    Interval.DAY_1: MILLIS_IN_DAY,
+    Interval.DAY_3: 3 * MILLIS_IN_DAY,
+    Interval.WEEK_1: 7 * MILLIS_IN_DAY
+}
+
+# Most klines /api/v3/klines returns per request
+PAGE_LIMIT = 1000
+
+
+def klines_to_frame(klines):
+    """ Converts /api/v3/klines rows into a DataFrame with KLINE_COLUMNS,
+    prices and volumes as floats """
+    frame = pd.DataFrame([kline[:len(KLINE_COLUMNS)] for kline in klines], columns=KLINE_COLUMNS)
+
+    for column in KLINE_COLUMNS:
+        frame[column] = frame[column].astype(np.int64 if column in INTEGER_COLUMNS else np.float64)
+
+    return frame
+
+
+class KlineCache(object):
+    """ Local cache of closed klines stored as Parquet files partitioned by
+    symbol, interval and UTC day ('<root>/<symbol>/<interval>/<day>.parquet').
+    A read works out which candles of the requested range are not on disk,
+    downloads only those ranges (paging through /api/v3/klines) and saves the
+    closed ones, so repeated historical queries become disk reads. Candles
+    that are still open are returned but never saved """
+
+    def __init__(self, binance_api, root="Kline_Cache"):
+        self.binance_api = binance_api
+        self.root = root
+        self.lock = Lock()
+
+    def get_path(self, symbol, interval, day):
+        return os.path.join(self.root, symbol, interval.value, "{0}.parquet".format(day.strftime("%Y-%m-%d")))
+
+    def get_days(self, start_time, end_time):
+        first_day = start_time - (start_time % MILLIS_IN_DAY)
+        return [datetime.datetime.utcfromtimestamp(day / 1000).date()
+                for day in range(first_day, end_time + 1, MILLIS_IN_DAY)]
+
+    def read_partitions(self, symbol, interval, start_time, end_time):
+        frames = []
+
+        for day in self.get_days(start_time, end_time):
+            path = self.get_path(symbol, interval, day)
+            if os.path.exists(path):
+                frames.append(pd.read_parquet(path))
+
+        if len(frames) == 0:
+            return klines_to_frame([])
+
+        return pd.concat(frames, ignore_index=True)
+
+    def write_partitions(self, symbol, interval, frame):
+        """ Merges closed klines into the day partitions they belong to """
+        days = pd.to_datetime(frame['open_time'], unit='ms').dt.date
+
+        for day, day_frame in frame.groupby(days):
+            path = self.get_path(symbol, interval, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            if os.path.exists(path):
+                day_frame = pd.concat([pd.read_parquet(path), day_frame], ignore_index=True)
+
+            day_frame = day_frame.drop_duplicates('open_time', keep='last').sort_values('open_time')
+            with atomic_write(path, "wb") as file:
+                day_frame.to_parquet(file, engine='pyarrow', index=False)
+
+    def get_missing_ranges(self, open_times, start_time, end_time, interval_millis):
+        """ Returns (start, end) open time ranges of the candles between
+        'start_time' and 'end_time' that are not in 'open_times' """
+        first_open_time = start_time + (-start_time % interval_millis)
+        expected = np.arange(first_open_time, end_time + 1, interval_millis, dtype=np.int64)
+        missing = np.setdiff1d(expected, open_times, assume_unique=True)
+
+        if len(missing) == 0:
+            return []
+
+        # Split wherever consecutive missing candles are more than one apart
+        breaks = np.flatnonzero(np.diff(missing) != interval_millis) + 1
+        return [(int(gap[0]), int(gap[-1])) for gap in np.split(missing, breaks)]
+
+    def fetch(self, symbol, interval, start_time, end_time, interval_millis):
+        """ Downloads the klines opening between 'start_time' and 'end_time'
+        one page at a time. Raises an exception if a page could not be fetched
+        rather than returning the klines with a hole in them """
+        klines = []
+
+        while start_time <= end_time:
+            page = self.binance_api.get_kline(symbol, interval, start_time, end_time, limit=PAGE_LIMIT, max_try_time=1)
+
+            if page is None:
+                raise Exception("Failed to get klines for {0} from {1} to {2}".format(symbol, start_time, end_time))
+
+            if len(page) == 0:
+                break
+
+            klines.extend(page)
+            start_time = int(page[-1][0]) + interval_millis
+
+            if len(page) < PAGE_LIMIT:
+                break
+
+        return klines_to_frame(klines)
+
+    def get_klines(self, symbol, interval, start_time, end_time=None):
+        """ Returns the klines of a symbol opening between 'start_time' and
+        'end_time' (now if None) as a DataFrame with KLINE_COLUMNS """
+        if interval not in INTERVAL_MILLIS:
+            raise ValueError("Interval {0} is not cached".format(interval.value))
+
+        interval_millis = INTERVAL_MILLIS[interval]
+        now = int(time.time() * 1000)
+        end_time = now if end_time is None else min(int(end_time), now)
+        start_time = int(start_time)
+
+        with self.lock:
+            cached = self.read_partitions(symbol, interval, start_time, end_time)
+            missing_ranges = self.get_missing_ranges(cached['open_time'].to_numpy(), start_time, end_time,
+                                                     interval_millis)
+
+            fetched = [self.fetch(symbol, interval, gap_start, gap_end, interval_millis)
+                       for gap_start, gap_end in missing_ranges]
+            fetched = [frame for frame in fetched if len(frame) > 0]
+
+            if len(fetched) > 0:
+                fetched = pd.concat(fetched, ignore_index=True)
+                closed = fetched[fetched['close_time'] < now]
+                if len(closed) > 0:
+                    self.write_partitions(symbol, interval, closed)
+                cached = pd.concat([cached, fetched], ignore_index=True)
+
+        in_range = (cached['open_time'] >= start_time) & (cached['open_time'] <= end_time)
+
+        return cached[in_range].drop_duplicates('open_time').sort_values('open_time').reset_index(drop=True)
@@ -1,5 +1,4 @@
 
-import requests
 import time
 import hmac
 import hashlib
@@ -7,10 +6,11 @@ from enum import Enum
 from threading import Lock
 
 from binanceapi.constant import RequestMethod, Interval, OrderSide, OrderStatus, OrderType
+from binanceapi.session import get_session
 
 class OptionClient(object):
 
-    def __init__(self, api_key=None, api_secret=None, host=None, timeout=5, try_counts=5):
+    def __init__(self, api_key=None, api_secret=None, host=None, timeout=5, try_counts=5, pool_size=10):
         self.api_key = api_key
         self.api_secret = api_secret
         self.host = host if host else 'https://testnet.binanceops.com'
@@ -19,6 +19,7 @@ class OptionClient(object):
         self.order_count_lock = Lock()
         self.order_count = 1_000_000
         self.try_counts = try_counts  # 失败尝试的次数.
+        self.session = get_session(self.host, pool_size=pool_size)
 
     def build_parameters(self, params: dict):
         keys = list(params.keys())
@@ -37,7 +38,7 @@ class OptionClient(object):
 
         for i in range(0, self.try_counts):
             try:
-                response = requests.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                response = self.session.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
                 if response.status_code == 200:
                     return response.json()
                 else:
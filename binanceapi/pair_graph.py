@@ -0,0 +1,50 @@
+class PairGraph(object):
+    """ Graph of the trading pairs with a node per coin and an edge per pair.
+    Adjacency sets are kept in both directions so the number of pairs a coin
+    trades in and whether two coins trade together are set lookups """
+
+    def __init__(self, pairs=()):
+        # base asset -> quote assets it trades against
+        self.quotes_by_base = {}
+        # quote asset -> base assets traded against it
+        self.bases_by_quote = {}
+        # Every coin in order of first appearance
+        self.coins = {}
+
+        for pair in pairs:
+            base_asset, quote_asset = pair.split("-")
+            self.add_pair(base_asset, quote_asset)
+
+    def add_pair(self, base_asset, quote_asset):
+        self.quotes_by_base.setdefault(base_asset, set()).add(quote_asset)
+        self.bases_by_quote.setdefault(quote_asset, set()).add(base_asset)
+        self.coins.setdefault(base_asset, None)
+        self.coins.setdefault(quote_asset, None)
+
+    def has_pair(self, base_asset, quote_asset):
+        return quote_asset in self.quotes_by_base.get(base_asset, ())
+
+    def get_pair_count(self, coin):
+        """ Returns the number of pairs a coin is the base or quote of """
+        return len(self.quotes_by_base.get(coin, ())) + len(self.bases_by_quote.get(coin, ()))
+
+    def get_pairs_per_coin(self):
+        return {coin: self.get_pair_count(coin) for coin in self.coins}
+
+    def get_wanted_coins(self, limit):
+        """ Returns the coins trading in at least 'limit' pairs """
+        return [coin for coin in self.coins if self.get_pair_count(coin) >= limit]
+
+    def get_pairs_between(self, coins):
+        """ Returns the BASE-QUOTE pairs whose base and quote are both in
+        'coins', ordered by the position of the base then the quote in 'coins' """
+        positions = {coin: position for position, coin in enumerate(coins)}
+        pairs = []
+
+        for base_asset in positions:
+            quote_assets = [quote_asset for quote_asset in self.quotes_by_base.get(base_asset, ())
+                            if quote_asset in positions]
+            quote_assets.sort(key=positions.get)
+            pairs.extend("{0}-{1}".format(base_asset, quote_asset) for quote_asset in quote_assets)
+
+        return pairs
@@ -0,0 +1,133 @@
+import multiprocessing as mp
+import os
+import time
+
+# Request weights of the spot endpoints used by the clients, taken from the
+# Binance spot API documentation. Endpoints not listed here weigh 1
+ENDPOINT_WEIGHTS = {
+    "/api/v3/time": 1,
+    "/api/v3/exchangeInfo": 10,
+    "/api/v3/klines": 1,
+    "/api/v3/aggTrades": 1,
+    "/api/v3/ticker/price": 1,
+    "/api/v3/ticker/bookTicker": 1,
+    "/api/v3/order/test": 1,
+    "/api/v3/account": 10,
+    "/api/v3/myTrades": 10,
+    "/api/v3/allOrders": 10,
+    "/sapi/v1/accountSnapshot": 1
+}
+
+# Weight of /api/v3/depth by the requested limit
+DEPTH_WEIGHTS = {5: 1, 10: 1, 20: 1, 50: 1, 100: 1, 500: 5, 1000: 10}
+
+USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-1M"
+
+# Indexes into the shared state array
+_TOKENS = 0
+_LAST_REFILL = 1
+_PAUSED_UNTIL = 2
+_WAITED_SECONDS = 3
+
+
+def get_request_weight(method, path, params=None):
+    """ Returns the request weight Binance charges for a call """
+    params = params if params else {}
+
+    if path == "/api/v3/depth":
+        return DEPTH_WEIGHTS.get(int(params.get("limit", 100)), 10)
+    elif path == "/api/v3/openOrders":
+        return 3 if "symbol" in params else 40
+    elif path == "/api/v3/order":
+        return 2 if method == "GET" else 1
+    elif path == "/api/v3/ticker/price" and "symbol" not in params:
+        return 2
+
+    return ENDPOINT_WEIGHTS.get(path, 1)
+
+
+class RateLimiter(object):
+    """ Token bucket over the REQUEST_WEIGHT limit of the spot API. Each call
+    takes its endpoint weight out of the bucket before it is sent and the
+    bucket refills continuously at limit / interval per second. The state is
+    kept in shared memory so one limiter passed to several processes gives them
+    a single budget. The used weight Binance reports in the response headers
+    only ever lowers the tokens available, so usage from outside the budget
+    (another machine on the same IP for example) is still respected """
+
+    def __init__(self, limit=1200, interval=60, safety_margin=0.9):
+        self.limit = limit
+        self.capacity = limit * safety_margin
+        self.refill_rate = self.capacity / interval
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('d', 4)
+        self.state[_TOKENS] = self.capacity
+        self.state[_LAST_REFILL] = time.time()
+
+    def _refill(self, now):
+        elapsed = now - self.state[_LAST_REFILL]
+        self.state[_TOKENS] = min(self.capacity, self.state[_TOKENS] + elapsed * self.refill_rate)
+        self.state[_LAST_REFILL] = now
+
+    def acquire(self, weight=1):
+        """ Blocks until 'weight' can be spent without going over the limit """
+        weight = min(weight, self.capacity)
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+
+                if now < self.state[_PAUSED_UNTIL]:
+                    wait = self.state[_PAUSED_UNTIL] - now
+                elif self.state[_TOKENS] >= weight:
+                    self.state[_TOKENS] -= weight
+                    return
+                else:
+                    wait = (weight - self.state[_TOKENS]) / self.refill_rate
+
+                self.state[_WAITED_SECONDS] += wait
+
+            time.sleep(wait)
+
+    def update(self, headers):
+        """ Lowers the tokens available to match the weight Binance says has
+        been used in the current minute """
+        used_weight = headers.get(USED_WEIGHT_HEADER)
+
+        if used_weight is None:
+            return
+
+        with self.lock:
+            self._refill(time.time())
+            self.state[_TOKENS] = min(self.state[_TOKENS], self.capacity - int(used_weight))
+
+    def pause(self, seconds):
+        """ Stops every process sharing the limiter from sending requests,
+        used when Binance answers with 429 or 418 """
+        with self.lock:
+            self.state[_PAUSED_UNTIL] = max(self.state[_PAUSED_UNTIL], time.time() + seconds)
+            self.state[_TOKENS] = 0.0
+
+    def get_stats(self):
+        with self.lock:
+            self._refill(time.time())
+            return {
+                "tokens": self.state[_TOKENS],
+                "capacity": self.capacity,
+                "waited_seconds": self.state[_WAITED_SECONDS]
+            }
+
+
+_rate_limiters = {}
+
+
+def get_rate_limiter():
+    """ Returns the rate limiter for clients which were not given one, shared
+    by every client in this process """
+    pid = os.getpid()
+
+    if pid not in _rate_limiters:
+        _rate_limiters[pid] = RateLimiter()
+
+    return _rate_limiters[pid]
@@ -0,0 +1,66 @@
+import os
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(object):
+    """ Keep-alive HTTP transport for a single host. Connections are held in a
+    urllib3 pool and reused across requests so only the first call to a host
+    pays for the TCP and TLS handshakes. The transport never retries, failed
+    requests are retried by the clients' own try_counts loops """
+
+    def __init__(self, host, pool_size=10):
+        self.host = host
+        self.pool_size = pool_size
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url=url, **kwargs)
+
+    def get_stats(self):
+        """ Returns the number of connections opened and reused since the
+        session was created """
+        opened = 0
+        requests_sent = 0
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is not None:
+                opened += pool.num_connections
+                requests_sent += pool.num_requests
+
+        return {
+            "host": self.host,
+            "requests": requests_sent,
+            "connections_opened": opened,
+            "connections_reused": requests_sent - opened
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def get_session(host, pool_size=10):
+    """ Returns the shared session for a host and pool size, creating it on
+    first use. Sessions are keyed by process id as well so a forked worker
+    never reuses sockets opened by its parent """
+    key = (os.getpid(), host, pool_size)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = PooledSession(host, pool_size=pool_size)
+            _sessions[key] = session
+
+    return session
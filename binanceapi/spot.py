@@ -3,16 +3,16 @@ import hmac
 import time
 from threading import Lock
 
-import requests
-
 from binanceapi.binance_response import BinanceResponse
 from binanceapi.constant import RequestMethod, Interval, OrderSide, OrderType
+from binanceapi.rate_limiter import get_rate_limiter, get_request_weight
+from binanceapi.session import get_session
 from utilities import log_error
 
 
 class BinanceSpotHttp(object):
 
-    def __init__(self, api_key, secret, host=None, timeout=60, try_counts=3):
+    def __init__(self, api_key, secret, host=None, timeout=60, try_counts=3, pool_size=10, rate_limiter=None):
         self.api_key = api_key
         self.secret = secret
         self.host = host if host else "https://api.binance.com"
@@ -21,6 +21,8 @@ class BinanceSpotHttp(object):
         self.order_count_lock = Lock()
         self.order_count = 1_000_000
         self.try_counts = try_counts  # 失败尝试的次数.
+        self.session = get_session(self.host, pool_size=pool_size)
+        self.rate_limiter = rate_limiter if rate_limiter else get_rate_limiter()
 
     def build_parameters(self, params: dict):
         keys = list(params.keys())
@@ -36,25 +38,33 @@ class BinanceSpotHttp(object):
         elif requery_dict:
             url += '?' + self.build_parameters(requery_dict)
         headers = {"X-MBX-APIKEY": self.api_key}
+        weight = get_request_weight(req_method.value, path, requery_dict)
 
         for i in range(0, self.try_counts):
             try:
-                response = requests.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                self.rate_limiter.acquire(weight)
+                response = self.session.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                self.rate_limiter.update(response.headers)
                 if response.status_code == 200:
                     return response.json()
                 elif response.status_code in (429, 418):
                     log_error(BinanceResponse(response.json()['code'], response.json()['msg'], response.status_code,
                                               response.reason))
-                    retry_after = int(response.headers["Retry-After"])
-                    if retry_after is not None:
-                        time.sleep(retry_after)
-                    else:
-                        time.sleep(60)
+                    # Pausing the limiter stops every process sharing it, not just this one
+                    retry_after = response.headers.get("Retry-After")
+                    self.rate_limiter.pause(int(retry_after) if retry_after is not None else 60)
                 else:
                     print(response.json(), response.status_code)
             except Exception as error:
                 print(f"Path:{path}, Error: {error}")
-                time.sleep(60)
+                # A timeout or dropped connection only holds back this
+                # request, the limiter is paused for 429 and 418 alone
+                if i + 1 < self.try_counts:
+                    time.sleep(2 ** i)
+
+    def get_connection_stats(self):
+        """ Returns the connections opened and reused by this client's host """
+        return self.session.get_stats()
 
     def get_server_time(self):
         try:
@@ -129,9 +139,11 @@ class BinanceSpotHttp(object):
         if end_time:
             query_dict['endTime'] = end_time
 
+        # An empty list is a valid answer (nothing traded in the range), None
+        # means the klines could not be fetched
         for i in range(max_try_time):
             data = self.request(RequestMethod.GET, path, query_dict)
-            if isinstance(data, list) and len(data):
+            if isinstance(data, list):
                 return data
 
     def get_latest_price(self, symbol):
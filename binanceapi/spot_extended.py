@@ -1,6 +1,7 @@
 import datetime
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import requests
@@ -10,84 +11,47 @@ import binanceapi.spot
 import urls as u
 from binanceapi.binance_response import BinanceResponse
 from binanceapi.constant import RequestMethod, OrderSide, OrderType, Interval, AccountType
+from binanceapi.kline_cache import KlineCache
+from binanceapi.pair_graph import PairGraph
+from binanceapi.rate_limiter import get_request_weight
+from binanceapi.symbol_universe import SymbolUniverse
+from binanceapi.vol_diff_batch import VolDiffBatch, sum_agg_trade_volumes
+from binanceapi.vol_diff_matrix import VolDiffMatrix, unique_in_order
 from utilities import save_file_trade, save_file_error, log_error
 
 
 class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
 
-    def __init__(self, api_key, secret, host=None, timeout=60, try_counts=3):
-        super().__init__(api_key, secret, host, timeout, try_counts)
+    def __init__(self, api_key, secret, host=None, timeout=60, try_counts=3, pool_size=10,
+                 rate_limiter=None):
+        super().__init__(api_key, secret, host, timeout, try_counts, pool_size, rate_limiter)
+        # Exchange info is downloaded once per TTL and shared by every method
+        self.symbol_universe = SymbolUniverse(self)
+        # Closed candles are read from disk once downloaded
+        self.kline_cache = KlineCache(self)
 
     def get_pairs(self):
-        path = "/api/v3/exchangeInfo"
-        pairs = np.array([])
-
-        exchange_info = self.request(req_method=RequestMethod.GET, path=path)
-
-        for symbol_info in exchange_info['symbols']:
-            if symbol_info['status'] == 'TRADING':
-                base_asset = symbol_info['baseAsset']
-                quote_asset = symbol_info['quoteAsset']
-                pair = "{0}-{1}".format(base_asset, quote_asset)
-                pairs = np.append(pairs, pair)
-
-        return pairs
+        """ Returns the trading pairs in BASE-QUOTE format """
+        return np.array(self.symbol_universe.get_pairs())
 
     def get_symbols(self):
-        path = "/api/v3/exchangeInfo"
-        symbols = np.array([])
-
-        exchange_info = self.request(req_method=RequestMethod.GET, path=path)
-
-        for symbol_info in exchange_info['symbols']:
-            if symbol_info['status'] == 'TRADING':
-                symbols = np.append(symbols, symbol_info['symbol'])
-
-        return symbols
+        """ Returns the trading symbols """
+        return np.array(self.symbol_universe.get_symbols())
 
     def get_pairs_per_coin(self, pairs):
         """ Gets the number of pairs each coin trades with. More pairs means a
         more accurate final Elo rating """
 
-        pairs_per_coin = {}
-
-        coin_arr = np.array([])
-
-        for pair in pairs:
-            coin1 = pair.split("-")[0]
-            coin2 = pair.split("-")[1]
-            coin_arr = np.append(coin_arr, coin1)
-            coin_arr = np.append(coin_arr, coin2)
-
-        for coin in coin_arr:
-            coin_count = 0
-            for pair in pairs:
-                if pair.find(coin) >= 0:
-                    coin_count += 1
-            pairs_per_coin[coin] = coin_count
-
-        return pairs_per_coin
+        return PairGraph(pairs).get_pairs_per_coin()
 
     def get_wanted_pairs(self, pairs_per_coin, limit):
         """ Returns the pairs available from the exchange which use coins that
         have a number of pairs they trade with higher than that decided in the
         'limit' """
 
-        wanted_coins = np.array([])
-        wanted_pairs = np.array([])
-
-        symbols = self.get_symbols()
-
-        for coin in pairs_per_coin:
-            if pairs_per_coin[coin] >= limit:
-                wanted_coins = np.append(wanted_coins, coin)
+        wanted_coins = [coin for coin in pairs_per_coin if pairs_per_coin[coin] >= limit]
 
-        for coin_a in wanted_coins:
-            for coin_b in wanted_coins:
-                if coin_a + coin_b in symbols:
-                    wanted_pairs = np.append(wanted_pairs, "{0}-{1}".format(coin_a, coin_b))
-
-        return wanted_pairs
+        return np.array(self.symbol_universe.get_pair_graph().get_pairs_between(wanted_coins))
 
     def get_wanted_coins(self, limit):
         """ Wanted_coins list is created by getting all trading
@@ -96,15 +60,7 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         coins. Using a minimum trading pairs value means that the elo rating
         calculation is more accurate """
 
-        pairs = self.get_pairs()
-        pairs_per_coin = self.get_pairs_per_coin(pairs)
-        wanted_coins = np.array([])
-
-        for coin in pairs_per_coin:
-            if pairs_per_coin[coin] >= limit:
-                wanted_coins = np.append(wanted_coins, coin)
-
-        return wanted_coins
+        return np.array(self.symbol_universe.get_pair_graph().get_wanted_coins(limit))
 
     def request_extended(self, req_method: RequestMethod, path: str, requery_dict=None, verify=False):
         url = self.host + path
@@ -115,18 +71,18 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         elif requery_dict:
             url += '?' + self.build_parameters(requery_dict)
         headers = {"X-MBX-APIKEY": self.api_key}
+        weight = get_request_weight(req_method.value, path, requery_dict)
 
         for i in range(0, self.try_counts):
             try:
-                response = requests.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                self.rate_limiter.acquire(weight)
+                response = self.session.request(req_method.value, url=url, headers=headers, timeout=self.timeout)
+                self.rate_limiter.update(response.headers)
                 if response.status_code in (429, 418):
                     log_error(BinanceResponse(response.json()['code'], response.json()['msg'], response.status_code,
                                               response.reason))
-                    retry_after = int(response.headers["Retry-After"])
-                    if retry_after is not None:
-                        time.sleep(retry_after)
-                    else:
-                        time.sleep(60)
+                    retry_after = response.headers.get("Retry-After")
+                    self.rate_limiter.pause(int(retry_after) if retry_after is not None else 60)
                 elif response.status_code == 200:
                     return BinanceResponse(0, response.json(), response.status_code, response.reason)
                 else:
@@ -135,6 +91,8 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
             except Exception as error:
                 log_error(error)
                 print(f"Path:{path}, Error: {error}")
+                if i + 1 < self.try_counts:
+                    time.sleep(2 ** i)
 
     def limit_sell_coin(self, symbols, current_coin, initial_price, expected_percent_change):
         """ Place a limit order to sell the current coin """
@@ -441,11 +399,13 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         pairs = self.get_pairs()
         pairs_per_coin = self.get_pairs_per_coin(pairs)
         wanted_pairs = self.get_wanted_pairs(pairs_per_coin, limit=pairs_per_coin_limit)
+        # Matched by symbol rather than substring, so OM does not match ROMA
+        coin_symbols = self.symbol_universe.get_coin_symbols(current_coin)
 
         user_trades_list = []
         for pair in wanted_pairs:
-            if pair.find(current_coin) >= 0:
-                symbol = pair.replace("-", "")
+            symbol = pair.replace("-", "")
+            if symbol in coin_symbols:
                 try:
                     user_trades = sorted(self.get_user_trades(symbol=symbol), key=lambda d: d['time'])
                 except Exception as e:
@@ -473,17 +433,12 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         """ Returns the total value in USDT of account """
 
         holdings_dict = {}
-        symbols = np.array([])
-
         assets = self.get_account_info()['balances']
 
         pairs = self.get_pairs()
         pairs_per_coin = self.get_pairs_per_coin(pairs)
         wanted_pairs = self.get_wanted_pairs(pairs_per_coin, limit=pairs_per_coin_limit)
-
-        for pair in wanted_pairs:
-            symbol = pair.replace("-", "")
-            symbols = np.append(symbols, symbol)
+        symbols = {pair.replace("-", "") for pair in wanted_pairs}
 
         for asset in assets:
             coin = asset['asset']
@@ -529,17 +484,12 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         """ Returns the coin which has the highest value held in USDT """
 
         holdings_dict = {}
-        symbols = np.array([])
-
         assets = self.get_account_info()['balances']
 
         pairs = self.get_pairs()
         pairs_per_coin = self.get_pairs_per_coin(pairs)
         wanted_pairs = self.get_wanted_pairs(pairs_per_coin, limit=pairs_per_coin_limit)
-
-        for pair in wanted_pairs:
-            symbol = pair.replace("-", "")
-            symbols = np.append(symbols, symbol)
+        symbols = {pair.replace("-", "") for pair in wanted_pairs}
 
         for asset in assets:
             coin = asset['asset']
@@ -567,7 +517,7 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
 
         return current_coin
 
-    def get_agg_trades(self, pair, start_time, end_time, limit=500):
+    def get_agg_trades(self, pair, start_time, end_time, limit=500, from_id=None):
         """
         Returns aggregate trades in the form of kLine for a pair between time
         interval
@@ -575,16 +525,65 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         :param start_time: Beginning of aggregate trade
         :param end_time: End of aggregate trade time
         :param limit: Data to return
+        :param from_id: Aggregate trade id to return trades from, replaces the times
         """
         path = "/api/v3/aggTrades"
-        params = {"symbol": pair.replace('-', ""),
-                  "startTime": start_time,
-                  "endTime": end_time,
-                  "limit": limit
-                  }
+
+        if from_id is not None:
+            params = {"symbol": pair.replace('-', ""),
+                      "fromId": from_id,
+                      "limit": limit
+                      }
+        else:
+            params = {"symbol": pair.replace('-', ""),
+                      "startTime": start_time,
+                      "endTime": end_time,
+                      "limit": limit
+                      }
         # print(f"params = {params}, {self.request(RequestMethod.GET, path, params)}")
         return self.request(RequestMethod.GET, path, params)
 
+    def iter_agg_trade_pages(self, pair, start_time, end_time, limit=1000):
+        """ Yields every aggregate trade between two times one page at a time.
+        The first page is found by time, one hour at a time as Binance does not
+        accept longer time ranges, and later pages follow the trade ids with
+        'fromId' until a trade after 'end_time' is reached. Raises an exception
+        if a page can not be fetched so the window can be retried as a whole """
+        millis_in_hour = 1000 * 60 * 60
+        window_start_time = start_time
+        from_id = None
+
+        while True:
+            if from_id is None:
+                window_end_time = min(end_time, window_start_time + millis_in_hour - 1)
+                page = self.get_agg_trades(pair, window_start_time, window_end_time, limit)
+            else:
+                page = self.get_agg_trades(pair, None, None, limit, from_id=from_id)
+
+            if not isinstance(page, list):
+                raise Exception(f"Failed to get aggregate trades for {pair} from {window_start_time} to {end_time}")
+
+            if from_id is None and len(page) == 0:
+                # Nothing traded in this hour, move on to the next one
+                if window_end_time >= end_time:
+                    return
+                window_start_time = window_end_time + 1
+                continue
+
+            if len(page) == 0:
+                return
+
+            if page[-1]['T'] > end_time:
+                yield [trade_entry for trade_entry in page if trade_entry['T'] <= end_time]
+                return
+
+            yield page
+
+            if len(page) < limit and (from_id is not None or window_end_time >= end_time):
+                return
+
+            from_id = page[-1]['a'] + 1
+
     def get_account_snapshot(self, account_type: AccountType, start_time: int, end_time: int):
 
         path = "/sapi/v1/accountSnapshot"
@@ -598,9 +597,38 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
 
         return self.request(RequestMethod.GET, path, params, verify=True)
 
-    def get_vol_diffs(self, minutes, interval_in_minutes, pairs_per_coin_limit):
+    def get_vol_diff(self, pair, start_time, end_time):
+        """ Returns (volume difference, pages fetched, seconds taken) for a
+        pair between two times or None if the trades could not be fetched. Every
+        trade in the window is counted, the pages are reduced into running buy
+        and sell volumes as they arrive so only one page is held at a time.
+        Each page request is already retried with backoff by request, so a
+        window is not retried again here """
+        try:
+            started = time.time()
+            pages = 0
+            buy_volume = 0
+            sell_volume = 0
+
+            for trade_data in self.iter_agg_trade_pages(pair, start_time, end_time):
+                pages += 1
+                page_buy_volume, page_sell_volume = sum_agg_trade_volumes(trade_data)
+                buy_volume += page_buy_volume
+                sell_volume += page_sell_volume
+
+            return buy_volume - sell_volume, pages, time.time() - started
+
+        except Exception as e:
+            log_error(e)
+            print(f"Error in vol_diffs {e}")
+
+        return None
+
+    def get_vol_diffs(self, minutes, interval_in_minutes, pairs_per_coin_limit, max_workers=8):
         """ Gets the volume differences for a 'wanted coins' between a time
-        interval """
+        interval. Every pair and interval is fetched concurrently by up to
+        'max_workers' threads which all draw from the client's rate limiter.
+        Windows whose trades could not be fetched are left out of the batch """
 
         today = datetime.datetime.utcfromtimestamp(self.get_current_timestamp() / 1000).replace(second=0, microsecond=0)
         epoch = datetime.datetime.utcfromtimestamp(0)
@@ -608,77 +636,49 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
 
         millis_in_min = 1000 * 60
 
-        vol_diff_list = []
+        connection_stats = self.get_connection_stats()
         pairs = self.get_pairs()
         pairs_per_coin = self.get_pairs_per_coin(pairs)
         wanted_pairs = self.get_wanted_pairs(pairs_per_coin, limit=pairs_per_coin_limit)
 
-        for minute in range(int(minutes / interval_in_minutes)):
-
-            for pair in wanted_pairs:
-
-                end_time = int(start_time + (millis_in_min * interval_in_minutes))
+        intervals = int(minutes / interval_in_minutes)
+        vol_diffs = VolDiffBatch.empty(intervals * len(wanted_pairs))
 
-                try:
-                    trade_data = self.get_agg_trades(pair, start_time, end_time, 100)
-                except Exception as e:
-                    log_error(e)
-                    print(f"Error in vol_diffs {e}")
-                    time.sleep(millis_in_min)
-                    trade_data = self.get_agg_trades(pair, start_time, end_time, 1000)
-
-                buy_volume = 0
-                sell_volume = 0
-
-                for trade_entry in trade_data:
-                    if trade_entry['m']:
-                        buy_volume += np.double(trade_entry['q'])
+        # Entries are laid out interval by interval, pairs in wanted order
+        for interval in range(intervals):
+            window_start_time = start_time + (millis_in_min * interval_in_minutes * interval)
+            window = slice(interval * len(wanted_pairs), (interval + 1) * len(wanted_pairs))
+            vol_diffs.pair[window] = wanted_pairs
+            vol_diffs.start_time[window] = window_start_time
+            vol_diffs.end_time[window] = window_start_time + (millis_in_min * interval_in_minutes)
 
-                    elif not trade_entry['m']:
-                        sell_volume += np.double(trade_entry['q'])
+        def fetch(i):
+            return self.get_vol_diff(vol_diffs.pair[i], int(vol_diffs.start_time[i]), int(vol_diffs.end_time[i]))
 
-                volume_diff = buy_volume - sell_volume
+        # More threads than pooled connections would just open throwaway connections
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, self.session.pool_size))) as executor:
+            for i, result in enumerate(executor.map(fetch, range(len(vol_diffs)))):
+                if result is not None:
+                    vol_diffs.vol_diff[i], vol_diffs.pages[i], vol_diffs.latency[i] = result
 
-                vol_diff_object = {
-                    "pair": pair,
-                    "start_time": start_time,
-                    "end_time": end_time,
-                    "vol_diff": volume_diff
-                }
+        self.print_connection_stats("get_vol_diffs", connection_stats)
 
-                vol_diff_list = np.append(vol_diff_list, vol_diff_object)
+        for pair, pair_stats in vol_diffs.get_pair_stats().items():
+            if pair_stats['pages'] > pair_stats['windows']:
+                print(f"get_vol_diffs: {pair} needed {pair_stats['pages']} pages over {pair_stats['windows']} "
+                      f"windows in {pair_stats['latency']:.2f}s")
 
-            start_time += millis_in_min * interval_in_minutes
+        return vol_diffs.select(~np.isnan(vol_diffs.vol_diff))
 
-        return vol_diff_list
-
-    def convert_vol_diffs_to_pair_dict(self, vol_diff_list):
+    def convert_vol_diffs_to_pair_dict(self, vol_diff_list, missing=0.0):
         """ Converts the volume difference dictionary from 'get_vol_diffs'
         method into a pair_dict so that it can be converted into Elo ratings.
         This is legacy from the original code and works correctly so made
-        sense to continue the pair_dict -> Elo conversion """
-        pair_dict = {}
-        times = self.getTimes(vol_diff_list)
-        pair_dict['timestamps'] = times
-
-        for vol_diff_entry in vol_diff_list:
-            pair = vol_diff_entry['pair']
-            start_time = vol_diff_entry['start_time']
-            end_time = vol_diff_entry['end_time']
-            vol_diff = vol_diff_entry['vol_diff']
-
-            if pair is not None and start_time is not None and end_time is not None and vol_diff is not None:
-
-                if pair not in pair_dict:
-                    pair_dict[pair] = np.full((len(times)), 0.0)
-
-                for timestamp in pair_dict['timestamps']:
-                    position = np.where(pair_dict['timestamps'] == timestamp)[0]
-
-                    if end_time == timestamp:
-                        pair_dict[pair][position] = vol_diff
-
-        return pair_dict
+        sense to continue the pair_dict -> Elo conversion. The entries are
+        pivoted into a pair x time matrix in one pass, see
+        VolDiffMatrix.to_pair_dict, and intervals a pair has no entry for are
+        'missing' (0.0 as elo.get_elos expects, NaN for elo_engine.get_elos) """
+        return VolDiffMatrix.from_entries(vol_diff_list).to_pair_dict(missing)
 
     def get_prices(self, quote_pair, minutes, interval_in_minutes, pairs_per_coin_limit):
         """ Gets prices for a set of trading pairs between two timestamps with
@@ -697,6 +697,7 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
         price_dict['timestamps'] = np.array([])
         iteration = 0
 
+        connection_stats = self.get_connection_stats()
         pairs = self.get_pairs()
         pairs_per_coin = self.get_pairs_per_coin(pairs)
         wanted_pairs = self.get_wanted_pairs(pairs_per_coin, limit=pairs_per_coin_limit)
@@ -706,14 +707,14 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
                 price_dict[pair] = np.array([])
                 symbol = pair.replace("-", "")
 
-                kline = self.get_kline(symbol, interval, start_time, end_time)
+                kline = self.kline_cache.get_klines(symbol, interval, start_time, end_time)
 
-                for i in range(len(kline)):
-                    timestamp = datetime.datetime.utcfromtimestamp(kline[i][0] / 1000)
-                    open_time = kline[i][0]
-                    close_time = kline[i][6]
-                    open_price = kline[i][1]
-                    close_price = kline[i][4]
+                for candle in kline.itertuples(index=False):
+                    timestamp = datetime.datetime.utcfromtimestamp(candle.open_time / 1000)
+                    open_time = int(candle.open_time)
+                    close_time = int(candle.close_time)
+                    open_price = float(candle.open)
+                    close_price = float(candle.close)
                     price_dict[pair] = np.append(price_dict[pair], close_price)
 
                     price_list_entry = {
@@ -730,27 +731,34 @@ class BinanceSpotExtendedHttp(binanceapi.spot.BinanceSpotHttp):
 
                 iteration += 1
 
+        self.print_connection_stats("get_prices", connection_stats)
+
         return price_list
 
-    def getTimes(self, vol_diff_list):
-        """ Gets the set of start times from the volume differences """
-        times = np.array([])
-        for vol_diff in vol_diff_list:
-            time = vol_diff['end_time']
-            if len(np.where(times == time)[0]) == 0 and time is not None:
-                times = np.append(times, time)
+    def print_connection_stats(self, label, previous_stats):
+        """ Prints the requests made and connections opened since
+        'previous_stats' was taken so reuse of the pooled connections can be
+        checked per call """
+        stats = self.get_connection_stats()
+        requests_made = stats['requests'] - previous_stats['requests']
+        connections_opened = stats['connections_opened'] - previous_stats['connections_opened']
+
+        print(f"{label}: {requests_made} requests, {connections_opened} connections opened, "
+              f"{requests_made - connections_opened} reused")
 
-        return np.sort(times)
+    def getTimes(self, vol_diff_list):
+        """ Gets the sorted set of end times from the volume differences """
+        return np.unique(np.array([vol_diff['end_time'] for vol_diff in vol_diff_list
+                                   if vol_diff['end_time'] is not None], dtype=np.int64))
 
     def getPairs(self, vol_diff_list):
-        """ Gets the set of pairs from the volume differences """
-        pairs = np.array([])
-        for vol_diff in vol_diff_list:
-            pair = vol_diff['pair']
-            if len(np.where(pairs == pair)[0]) == 0 and pair is not None:
-                pairs = np.append(pairs, pair)
-
-        return pairs
+        """ Gets the set of pairs from the volume differences in the order
+        they first appear """
+        pairs = np.array([vol_diff['pair'] for vol_diff in vol_diff_list if vol_diff['pair'] is not None], dtype=str)
+        if len(pairs) == 0:
+            return pairs
+
+        return unique_in_order(pairs)[0]
 
     def get_interval(self, interval_in_minutes):
         """ Converts an integer in minutes into an Interval enum """
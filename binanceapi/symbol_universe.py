@@ -0,0 +1,133 @@
+import time
+from threading import Lock
+
+from binanceapi.pair_graph import PairGraph
+
+
+class SymbolUniverse(object):
+    """ Cached view of /api/v3/exchangeInfo. The payload is downloaded at most
+    once per 'ttl' seconds and indexed so symbol, coin and filter lookups are
+    dictionary lookups. The indexes are rebuilt on every successful download,
+    so filter changes on an unchanged set of symbols are picked up. 'version'
+    is increased whenever a refresh finds that the set of symbols or their
+    status has changed, so callers holding derived data (wanted pairs for
+    example) know when to rebuild it """
+
+    def __init__(self, binance_api, ttl=300):
+        self.binance_api = binance_api
+        self.ttl = ttl
+        self.lock = Lock()
+        self.fetched_at = 0.0
+        self.version = 0
+        self.checksum = None
+
+        # symbol -> symbol info for every symbol, whatever its status
+        self.symbol_info = {}
+        # Trading symbols only, in exchange info order
+        self.symbols = []
+        self.pairs = []
+        # symbol -> (base asset, quote asset)
+        self.base_quote = {}
+        # coin -> set of trading symbols it is the base or quote of
+        self.coin_symbols = {}
+        # symbol -> {filter type -> filter}
+        self.filters = {}
+        self.pair_graph = PairGraph()
+
+    def refresh(self, force=False):
+        """ Downloads exchange info if the cached copy is older than the TTL.
+        If the download fails the previous copy is kept """
+        with self.lock:
+            if not force and self.checksum is not None and time.time() - self.fetched_at < self.ttl:
+                return
+
+            exchange_info = self.binance_api.get_exchange_info()
+
+            if exchange_info is None or 'symbols' not in exchange_info:
+                return
+
+            self.fetched_at = time.time()
+            checksum = hash(tuple((info['symbol'], info['status']) for info in exchange_info['symbols']))
+
+            self._build(exchange_info['symbols'])
+
+            if checksum != self.checksum:
+                self.checksum = checksum
+                self.version += 1
+
+    def _build(self, symbol_infos):
+        symbol_info = {}
+        symbols = []
+        pairs = []
+        base_quote = {}
+        coin_symbols = {}
+        filters = {}
+        pair_graph = PairGraph()
+
+        for info in symbol_infos:
+            symbol = info['symbol']
+            symbol_info[symbol] = info
+            filters[symbol] = {symbol_filter['filterType']: symbol_filter for symbol_filter in info.get('filters', [])}
+
+            if info['status'] == 'TRADING':
+                base_asset = info['baseAsset']
+                quote_asset = info['quoteAsset']
+                symbols.append(symbol)
+                pairs.append("{0}-{1}".format(base_asset, quote_asset))
+                base_quote[symbol] = (base_asset, quote_asset)
+                coin_symbols.setdefault(base_asset, set()).add(symbol)
+                coin_symbols.setdefault(quote_asset, set()).add(symbol)
+                pair_graph.add_pair(base_asset, quote_asset)
+
+        self.symbol_info = symbol_info
+        self.symbols = symbols
+        self.pairs = pairs
+        self.base_quote = base_quote
+        self.coin_symbols = coin_symbols
+        self.filters = filters
+        self.pair_graph = pair_graph
+
+    def get_symbols(self):
+        """ Returns the trading symbols e.g. BTCUSDT """
+        self.refresh()
+        return self.symbols
+
+    def get_pairs(self):
+        """ Returns the trading pairs in BASE-QUOTE format e.g. BTC-USDT """
+        self.refresh()
+        return self.pairs
+
+    def get_pair_graph(self):
+        self.refresh()
+        return self.pair_graph
+
+    def has_symbol(self, symbol):
+        self.refresh()
+        return symbol in self.base_quote
+
+    def has_pair(self, base_asset, quote_asset):
+        return self.has_symbol(base_asset + quote_asset)
+
+    def get_base_quote(self, symbol):
+        """ Returns (base asset, quote asset) of a trading symbol or None """
+        self.refresh()
+        return self.base_quote.get(symbol)
+
+    def get_coin_symbols(self, coin):
+        """ Returns the trading symbols a coin is part of """
+        self.refresh()
+        return self.coin_symbols.get(coin, set())
+
+    def get_filter(self, symbol, filter_type):
+        """ Returns a filter such as LOT_SIZE or PRICE_FILTER for a symbol or
+        None if the symbol has no such filter """
+        self.refresh()
+        return self.filters.get(symbol, {}).get(filter_type)
+
+    def get_step_size(self, symbol):
+        lot_size = self.get_filter(symbol, 'LOT_SIZE')
+        return float(lot_size['stepSize']) if lot_size else None
+
+    def get_tick_size(self, symbol):
+        price_filter = self.get_filter(symbol, 'PRICE_FILTER')
+        return float(price_filter['tickSize']) if price_filter else None
@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from binanceapi.vol_diff_matrix import VolDiffMatrix
+
+RECORD_DTYPE = np.dtype([
+    ('pair', 'U24'),
+    ('start_time', np.int64),
+    ('end_time', np.int64),
+    ('vol_diff', np.float64),
+    ('pages', np.int32),
+    ('latency', np.float64)
+])
+
+
+def sum_agg_trade_volumes(trade_data):
+    """ Returns (buy volume, sell volume) of a page of aggregate trades. The
+    page is decoded into a float64 quantity array and a bool maker flag array
+    and both sums come out of one weighted bincount over the flag """
+    count = len(trade_data)
+    quantities = np.fromiter((trade_entry['q'] for trade_entry in trade_data), dtype=np.float64, count=count)
+    maker_flags = np.fromiter((trade_entry['m'] for trade_entry in trade_data), dtype=bool, count=count)
+
+    sell_volume, buy_volume = np.bincount(maker_flags, weights=quantities, minlength=2)
+
+    return float(buy_volume), float(sell_volume)
+
+
+@dataclass
+class VolDiffBatch:
+    """ Volume differences of one collection cycle stored column-wise, one
+    entry per pair and interval, along with the aggTrades pages fetched and
+    seconds taken for each entry. Iterating over a batch yields the same
+    dictionaries get_vol_diffs used to return so it can be posted row by row """
+    pair: np.ndarray
+    start_time: np.ndarray
+    end_time: np.ndarray
+    vol_diff: np.ndarray
+    pages: np.ndarray
+    latency: np.ndarray
+
+    @classmethod
+    def empty(cls, size):
+        return cls(
+            pair=np.empty(size, dtype=object),
+            start_time=np.zeros(size, dtype=np.int64),
+            end_time=np.zeros(size, dtype=np.int64),
+            vol_diff=np.full(size, np.nan, dtype=np.float64),
+            pages=np.zeros(size, dtype=np.int32),
+            latency=np.zeros(size, dtype=np.float64)
+        )
+
+    def __len__(self):
+        return len(self.pair)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield {
+                "pair": str(self.pair[i]),
+                "start_time": int(self.start_time[i]),
+                "end_time": int(self.end_time[i]),
+                "vol_diff": float(self.vol_diff[i])
+            }
+
+    def select(self, mask):
+        """ Returns a new batch holding the entries where 'mask' is True """
+        return VolDiffBatch(
+            pair=self.pair[mask],
+            start_time=self.start_time[mask],
+            end_time=self.end_time[mask],
+            vol_diff=self.vol_diff[mask],
+            pages=self.pages[mask],
+            latency=self.latency[mask]
+        )
+
+    def get_pair_stats(self):
+        """ Returns the windows, aggTrades pages and seconds spent per pair """
+        pair_stats = {}
+
+        for pair, pages, latency in zip(self.pair, self.pages, self.latency):
+            stats = pair_stats.setdefault(pair, {'windows': 0, 'pages': 0, 'latency': 0.0})
+            stats['windows'] += 1
+            stats['pages'] += int(pages)
+            stats['latency'] += float(latency)
+
+        return pair_stats
+
+    def to_dicts(self):
+        return list(self)
+
+    def to_records(self):
+        """ Returns the batch as a NumPy structured array """
+        records = np.empty(len(self), dtype=RECORD_DTYPE)
+
+        for name in RECORD_DTYPE.names:
+            records[name] = getattr(self, name)
+
+        return records
+
+    def to_matrix(self):
+        """ Returns the batch as a VolDiffMatrix """
+        return VolDiffMatrix.from_batch(self)
+
+    def to_frame(self):
+        return pd.DataFrame({name: getattr(self, name) for name in RECORD_DTYPE.names})
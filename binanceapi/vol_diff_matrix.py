@@ -0,0 +1,178 @@
+import base64
+from dataclasses import dataclass
+
+import numpy as np
+
+# Dtypes the matrix values can be sent to the API as, little-endian whatever
+# the machine
+API_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float64': np.dtype('<f8')
+}
+
+FIELDS = ('pair', 'start_time', 'end_time', 'vol_diff')
+
+
+def unique_in_order(values):
+    """ Returns the distinct values of an array in the order they first
+    appear, along with the index of each value in that result """
+    unique_values, first_index, inverse = np.unique(values, return_index=True, return_inverse=True)
+    order = np.argsort(first_index)
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+
+    return unique_values[order], rank[inverse]
+
+
+def vol_diffs_to_matrix(vol_diff_list):
+    """ Pivots volume difference entries into (pairs, timestamps, vol_diffs)
+    where 'vol_diffs' is a timestamps x pairs matrix, see VolDiffMatrix """
+    matrix = VolDiffMatrix.from_entries(vol_diff_list)
+
+    return matrix.pairs, matrix.end_times, matrix.values
+
+
+@dataclass
+class VolDiffMatrix:
+    """ Volume differences as one intervals x pairs matrix, NaN where a pair
+    has no volume difference for an interval, with the pair names and the
+    start and end time of each interval as index vectors. Intervals are sorted
+    by end time and pairs are in the order they were first seen. This is the
+    form vol_diffs are exchanged in between get_vol_diffs, the server and the
+    Elo engine: one contiguous buffer instead of a dictionary per entry.
+    Converters to and from API payloads (to_api), SQL rows (to_rows) and .npz
+    files (save) are provided, as well as the entry dictionaries the older
+    endpoints use (to_entries) """
+    pairs: np.ndarray
+    start_times: np.ndarray
+    end_times: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            pairs=np.array([], dtype=str),
+            start_times=np.array([], dtype=np.int64),
+            end_times=np.array([], dtype=np.int64),
+            values=np.empty((0, 0), dtype=np.float64)
+        )
+
+    @classmethod
+    def from_columns(cls, pair, start_time, end_time, vol_diff):
+        """ Pivots one entry per element of the column arrays. A later entry
+        for the same pair and end time replaces an earlier one """
+        if len(pair) == 0:
+            return cls.empty()
+
+        end_times, time_index = np.unique(np.asarray(end_time, dtype=np.int64), return_inverse=True)
+        start_times = np.empty(len(end_times), dtype=np.int64)
+        start_times[time_index] = np.asarray(start_time, dtype=np.int64)
+
+        pairs, pair_index = unique_in_order(np.asarray(pair, dtype=str))
+
+        values = np.full((len(end_times), len(pairs)), np.nan, dtype=np.float64)
+        values[time_index, pair_index] = np.asarray(vol_diff, dtype=np.float64)
+
+        return cls(pairs, start_times, end_times, values)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds a matrix from (pair, start_time, end_time, vol_diff) rows,
+        as read from `crypto_db`.`vol_diff`. Rows with a missing field are
+        left out """
+        rows = [row for row in rows if all(value is not None for value in row)]
+        if len(rows) == 0:
+            return cls.empty()
+
+        pair, start_time, end_time, vol_diff = zip(*rows)
+
+        return cls.from_columns(pair, start_time, end_time, vol_diff)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """ Builds a matrix from the dictionaries of the VolDiff endpoints """
+        return cls.from_rows([tuple(entry[field] for field in FIELDS) for entry in entries])
+
+    @classmethod
+    def from_batch(cls, batch):
+        """ Builds a matrix from a VolDiffBatch """
+        return cls.from_columns(batch.pair, batch.start_time, batch.end_time, batch.vol_diff)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def count(self):
+        """ Returns the number of volume differences held """
+        return int(np.count_nonzero(~np.isnan(self.values)))
+
+    def select_after(self, end_time):
+        """ Returns the intervals ending after 'end_time' """
+        keep = self.end_times > end_time
+
+        return VolDiffMatrix(self.pairs, self.start_times[keep], self.end_times[keep], self.values[keep])
+
+    def select_between(self, start_time, end_time):
+        """ Returns the intervals starting at or after 'start_time' and ending
+        at or before 'end_time' """
+        keep = (self.start_times >= start_time) & (self.end_times <= end_time)
+
+        return VolDiffMatrix(self.pairs, self.start_times[keep], self.end_times[keep], self.values[keep])
+
+    def to_rows(self):
+        """ Returns the volume differences as (pair, start_time, end_time,
+        vol_diff) tuples of Python types, interval by interval, ready for
+        executemany """
+        time_index, pair_index = np.nonzero(~np.isnan(self.values))
+
+        return list(zip(
+            self.pairs[pair_index].tolist(),
+            self.start_times[time_index].tolist(),
+            self.end_times[time_index].tolist(),
+            self.values[time_index, pair_index].tolist()
+        ))
+
+    def to_entries(self):
+        return [dict(zip(FIELDS, row)) for row in self.to_rows()]
+
+    def to_pair_dict(self, missing=0.0):
+        """ Returns the legacy pair_dict elo.get_elos takes: the end times
+        under 'timestamps' and an array of volume differences per pair, with
+        'missing' where a pair has none for an interval """
+        values = np.where(np.isnan(self.values), missing, self.values)
+
+        pair_dict = {'timestamps': self.end_times}
+        for i, pair in enumerate(self.pairs):
+            pair_dict[str(pair)] = values[:, i]
+
+        return pair_dict
+
+    def to_api(self, dtype='float64'):
+        """ Returns a JSON serialisable payload holding the values as one
+        base64 encoded buffer of 'dtype' """
+        return {
+            "pairs": self.pairs.tolist(),
+            "start_times": self.start_times.tolist(),
+            "end_times": self.end_times.tolist(),
+            "dtype": dtype,
+            "values": base64.b64encode(self.values.astype(API_DTYPES[dtype]).tobytes()).decode('ascii')
+        }
+
+    @classmethod
+    def from_api(cls, payload):
+        values = np.frombuffer(base64.b64decode(payload['values']), dtype=API_DTYPES[payload['dtype']])
+
+        return cls(
+            pairs=np.array(payload['pairs'], dtype=str),
+            start_times=np.array(payload['start_times'], dtype=np.int64),
+            end_times=np.array(payload['end_times'], dtype=np.int64),
+            values=values.astype(np.float64).reshape(len(payload['end_times']), len(payload['pairs']))
+        )
+
+    def save(self, path):
+        np.savez(path, pairs=self.pairs, start_times=self.start_times, end_times=self.end_times, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as file:
+            return cls(file['pairs'], file['start_times'], file['end_times'], file['values'])
@@ -4,9 +4,36 @@ Created on Mon Nov 15 21:55:32 2021
 
 @author: Dell
 """
+import glob
+import os
+import pickle
+import re
+
+import numpy as np
+
+from utilities import atomic_write
+
+STATISTICS_DTYPE = np.dtype([
+    ('coin', 'U16'),
+    ('moving_average_n', np.int16),
+    ('minutes_forward', np.int16),
+    ('slope', np.float64),
+    ('intercept', np.float64),
+    ('r_value', np.float64),
+    ('p_value', np.float64),
+    ('std_err', np.float64),
+    ('change_at_3sd', np.float64),
+    ('datapoints', np.int64),
+    ('timestamp', np.int64)
+])
+
+STORE_PATH = "Correlation_Statistics/Correlation_Statistics.npy"
 
 
 class CorrelationStatistics:
+    __slots__ = ('coin', 'strongest_minute', 'slope', 'intercept', 'r_value', 'p_value', 'std_err',
+                 'change_at_3sd', 'datapoints', 'timestamp')
+
     def __init__(self, coin, strongest_minute, slope, intercept, r_value, p_value, std_err, change_at_3sd, datapoints, timestamp):
         self.coin = coin
         self.strongest_minute = strongest_minute
@@ -18,3 +45,148 @@ class CorrelationStatistics:
         self.change_at_3sd = change_at_3sd
         self.datapoints = datapoints
         self.timestamp = timestamp
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # Pickles written before __slots__ hold the instance __dict__ and
+        # predate the datapoints and timestamp attributes
+        if isinstance(state, tuple):
+            state = state[1]
+
+        for name in self.__slots__:
+            setattr(self, name, state.get(name, 0))
+
+
+class CorrelationStatisticsStore(object):
+    """ Correlation statistics of every coin, moving average length and lag in
+    one NumPy structured array (see STATISTICS_DTYPE) sorted by coin, so the
+    whole set is loaded with a single read from one .npy file and a coin's
+    rows are found with a binary search """
+
+    def __init__(self, records=None):
+        if records is None:
+            records = np.empty(0, dtype=STATISTICS_DTYPE)
+
+        self.records = np.sort(records.astype(STATISTICS_DTYPE), order=('coin', 'moving_average_n', 'minutes_forward'))
+
+    @classmethod
+    def load(cls, path=STORE_PATH):
+        """ Returns the saved store or an empty one if nothing is saved yet """
+        if not os.path.exists(path):
+            return cls()
+
+        return cls(np.load(path))
+
+    def save(self, path=STORE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with atomic_write(path, "wb") as file:
+            np.save(file, self.records)
+
+    def merge(self, other):
+        """ Returns a store with the rows of 'other' and the rows of this store
+        for the coins, moving average lengths and lags 'other' has none for """
+        keys = ('coin', 'moving_average_n', 'minutes_forward')
+        replaced = np.isin(self.records[list(keys)], other.records[list(keys)])
+
+        return CorrelationStatisticsStore(np.concatenate([self.records[~replaced], other.records]))
+
+    @classmethod
+    def from_pickles(cls, directory="Correlation_Statistics"):
+        """ Builds a store from the per coin CorrelationStatistics pickles, i.e.
+        Correlation_Statistics_<coin>.p and
+        Correlation_Statistics_<n>_point_moving_average_<coin>.p """
+        pattern = re.compile(r"Correlation_Statistics_(?:(\d+)_point_moving_average_)?([A-Z0-9]+)\.p$")
+        rows = []
+
+        for path in sorted(glob.glob(os.path.join(directory, "Correlation_Statistics_*.p"))):
+            match = pattern.search(os.path.basename(path))
+            if match is None:
+                continue
+
+            with open(path, "rb") as file:
+                coin_stats = pickle.load(file)
+
+            rows.append((
+                coin_stats.coin,
+                int(match.group(1) or 0),
+                coin_stats.strongest_minute,
+                coin_stats.slope,
+                coin_stats.intercept,
+                coin_stats.r_value,
+                coin_stats.p_value,
+                coin_stats.std_err,
+                coin_stats.change_at_3sd,
+                coin_stats.datapoints,
+                coin_stats.timestamp
+            ))
+
+        return cls(np.array(rows, dtype=STATISTICS_DTYPE))
+
+    @classmethod
+    def from_statistics(cls, statistics, moving_average_n):
+        """ Builds a store from Statistics endpoint entries, see
+        statistical_analysis.get_coin_stats """
+        return cls(np.array([(
+            entry['coin'],
+            moving_average_n,
+            entry['minutes_forward'],
+            entry['slope'],
+            entry['intercept'],
+            entry['r_value'],
+            entry['p_value'],
+            entry['std_err'],
+            entry['change_at_3sd'],
+            entry['datapoints'],
+            entry['timestamp']
+        ) for entry in statistics], dtype=STATISTICS_DTYPE))
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_coins(self):
+        return np.unique(self.records['coin'])
+
+    def get_coin_records(self, coin, moving_average_n=None):
+        """ Returns a view of a coin's rows, optionally limited to one moving
+        average length """
+        coins = self.records['coin']
+        records = self.records[np.searchsorted(coins, coin, side='left'):np.searchsorted(coins, coin, side='right')]
+
+        if moving_average_n is not None:
+            records = records[records['moving_average_n'] == moving_average_n]
+
+        return records
+
+    def get(self, coin, minutes_forward=None, moving_average_n=None, min_timestamp=None):
+        """ Returns the CorrelationStatistics of a coin at a lag, or at the lag
+        with the lowest p value if 'minutes_forward' is None. Rows computed
+        before 'min_timestamp' are left out if it is given. Returns None if
+        there is no such row """
+        records = self.get_coin_records(coin, moving_average_n)
+
+        if minutes_forward is not None:
+            records = records[records['minutes_forward'] == minutes_forward]
+
+        if min_timestamp is not None:
+            records = records[records['timestamp'] >= min_timestamp]
+
+        if len(records) == 0:
+            return None
+
+        record = records[np.argmin(records['p_value'])]
+
+        return CorrelationStatistics(
+            coin=str(record['coin']),
+            strongest_minute=int(record['minutes_forward']),
+            slope=float(record['slope']),
+            intercept=float(record['intercept']),
+            r_value=float(record['r_value']),
+            p_value=float(record['p_value']),
+            std_err=float(record['std_err']),
+            change_at_3sd=float(record['change_at_3sd']),
+            datapoints=int(record['datapoints']),
+            timestamp=int(record['timestamp'])
+        )
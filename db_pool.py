@@ -0,0 +1,151 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """ Bounded pool of database connections. At most 'size' connections are
+    open at once, a request for a connection waits up to 'timeout' seconds for
+    one to be returned when they are all in use. Connections idle for longer
+    than 'health_check_interval' seconds are pinged (and reconnected if needed)
+    before being handed out. Any transaction left open is rolled back when a
+    connection is returned so the next user never sees a stale snapshot """
+
+    def __init__(self, connect, size=10, timeout=30, health_check_interval=30):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        # (connection, returned at) pairs, most recently returned last so
+        # idle connections age out at the front
+        self.idle = []
+        self.lock = threading.Lock()
+        # Notified whenever a connection is returned or one fewer is open, so
+        # a waiting checkout either takes it or opens a new one
+        self.available = threading.Condition(self.lock)
+
+        self.created = 0
+        self.in_use = 0
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "health_checks": 0,
+            "discarded": 0,
+            "peak_in_use": 0
+        }
+
+    def _open(self):
+        try:
+            return self.connect()
+        except Exception:
+            with self.available:
+                self.created -= 1
+                self.available.notify()
+            raise
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self.available:
+            self.created -= 1
+            self.stats["discarded"] += 1
+            self.available.notify()
+
+    def _checkout(self):
+        conn = None
+        started = None
+
+        with self.available:
+            while True:
+                if len(self.idle) > 0:
+                    conn, returned_at = self.idle.pop()
+                    break
+
+                if self.created < self.size:
+                    self.created += 1
+                    break
+
+                now = time.time()
+                if started is None:
+                    started = now
+                    self.stats["waits"] += 1
+
+                remaining = started + self.timeout - now
+                if remaining <= 0:
+                    self.stats["wait_seconds"] += now - started
+                    raise PoolExhaustedError(f"No database connection free after {self.timeout}s")
+
+                self.available.wait(remaining)
+
+            if started is not None:
+                self.stats["wait_seconds"] += time.time() - started
+
+        if conn is None:
+            conn, returned_at = self._open(), time.time()
+
+        if time.time() - returned_at > self.health_check_interval:
+            with self.lock:
+                self.stats["health_checks"] += 1
+            try:
+                conn.ping(reconnect=True)
+            except Exception:
+                # The dead connection's slot is reused for its replacement
+                # rather than freed, so no waiting checkout can take it
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+                with self.lock:
+                    self.stats["discarded"] += 1
+                conn = self._open()
+
+        with self.lock:
+            self.in_use += 1
+            self.stats["checkouts"] += 1
+            self.stats["peak_in_use"] = max(self.stats["peak_in_use"], self.in_use)
+
+        return conn
+
+    def _checkin(self, conn):
+        with self.lock:
+            self.in_use -= 1
+
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        with self.available:
+            self.idle.append((conn, time.time()))
+            self.available.notify()
+
+    @contextmanager
+    def connection(self):
+        """ Checks a connection out of the pool for the duration of a with
+        block and returns it afterwards """
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = self.size
+            stats["open"] = self.created
+            stats["in_use"] = self.in_use
+            stats["idle"] = len(self.idle)
+
+        return stats
@@ -0,0 +1,261 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+import elo
+from binanceapi.vol_diff_matrix import VolDiffMatrix
+from utilities import atomic_write
+
+# Can be set to match elo.get_elos if check_parity shows they differ
+INITIAL_RATING = float(os.environ.get("ELO_INITIAL_RATING", 1500.0))
+K_FACTOR = float(os.environ.get("ELO_K_FACTOR", 32.0))
+
+STATE_PATH = "Elo_State/Elo_State.json"
+# Last window of vol_diffs the elo_worker rated, the default input of
+# check_parity
+RECORDING_PATH = "Elo_State/Elo_Window.npz"
+
+# Span of vol_diffs rated together, from the initial ratings. The elo_worker
+# has always rated the last hour of vol_diffs every cycle
+WINDOW_MILLIS = 1000 * 60 * 60
+
+# Largest difference between two ratings of the same coin and interval for
+# the engine to count as giving the same ratings as elo.get_elos
+PARITY_TOLERANCE = 1e-6
+
+
+class EloEngine(object):
+    """ Elo ratings of every coin over a sequence of intervals. Each pair
+    BASE-QUOTE is a match between its two coins, won by the base coin if its
+    volume difference is positive, by the quote coin if it is negative and
+    drawn if it is zero, scored as
+
+        expected base score   E = 1 / (1 + 10 ** ((R_quote - R_base) / 400))
+        actual base score     S = (sign(vol_diff) + 1) / 2
+        rating change         R_base += K * (S - E), R_quote -= K * (S - E)
+
+    Matches are played one at a time, interval by interval and within an
+    interval in the order of the pairs (the order of the pair_dict), each
+    against the ratings left by the match before, as elo.get_elos plays them.
+    Pairs without a volume difference (NaN) in an interval are skipped.
+    The engine only replaces elo.get_elos in the elo_worker when ELO_RATER is
+    'engine', which should only be set once check_parity passes on a recorded
+    window (run this module, see main) """
+
+    def __init__(self, pairs, k=K_FACTOR, initial_rating=INITIAL_RATING):
+        self.pairs = list(pairs)
+        self.k = k
+        self.initial_rating = initial_rating
+
+        bases = [pair.split("-")[0] for pair in self.pairs]
+        quotes = [pair.split("-")[1] for pair in self.pairs]
+
+        # Coins in the order they first appear in the pairs
+        self.coins = list(dict.fromkeys(coin for pair in zip(bases, quotes) for coin in pair))
+        coin_index = {coin: i for i, coin in enumerate(self.coins)}
+
+        self.base_index = np.array([coin_index[coin] for coin in bases], dtype=np.intp)
+        self.quote_index = np.array([coin_index[coin] for coin in quotes], dtype=np.intp)
+
+    def get_initial_ratings(self, coin_ratings=None):
+        """ Returns the starting rating of each coin in self.coins, taken from
+        the 'coin_ratings' dictionary where it has one """
+        coin_ratings = coin_ratings if coin_ratings else {}
+
+        return np.array([coin_ratings.get(coin, self.initial_rating) for coin in self.coins], dtype=np.float64)
+
+    def rate(self, vol_diffs, ratings=None):
+        """ Returns the ratings (intervals x coins) at the end of each interval
+        of 'vol_diffs' (intervals x pairs, in the order of self.pairs),
+        starting from 'ratings' (one per coin in self.coins) or the initial
+        rating """
+        vol_diffs = np.atleast_2d(np.asarray(vol_diffs, dtype=np.float64))
+        ratings = self.get_initial_ratings() if ratings is None else np.array(ratings, dtype=np.float64)
+
+        played = ~np.isnan(vol_diffs)
+        scores = (np.sign(np.where(played, vol_diffs, 0.0)) + 1.0) / 2.0
+        history = np.empty((len(vol_diffs), len(self.coins)), dtype=np.float64)
+
+        for interval in range(len(vol_diffs)):
+            for pair in np.flatnonzero(played[interval]):
+                base = self.base_index[pair]
+                quote = self.quote_index[pair]
+
+                expected = 1.0 / (1.0 + 10.0 ** ((ratings[quote] - ratings[base]) / 400.0))
+                change = self.k * (scores[interval, pair] - expected)
+                ratings[base] += change
+                ratings[quote] -= change
+
+            history[interval] = ratings
+
+        return history
+
+
+def get_elos(pair_dict, interval_millis=None, k=K_FACTOR, initial_rating=INITIAL_RATING, coin_ratings=None):
+    """ Returns the Elo entries (coin, start_time, end_time, elo_rating) of
+    every coin at every interval of a pair_dict from
+    convert_vol_diffs_to_pair_dict, ready to post to the Elo endpoints.
+    Intervals a pair has no volume difference for must be NaN
+    (convert_vol_diffs_to_pair_dict(..., missing=np.nan)) to be skipped, a 0.0
+    is scored as a draw. 'interval_millis' is the length of an interval and is
+    taken from the spacing of the timestamps if None. Ratings continue from
+    'coin_ratings' (coin -> rating, see EloState) for the coins it holds """
+    end_times = np.asarray(pair_dict['timestamps'], dtype=np.int64)
+    pairs = [pair for pair in pair_dict if pair != 'timestamps']
+
+    if len(end_times) == 0 or len(pairs) == 0:
+        return []
+
+    if interval_millis is None:
+        if len(end_times) < 2:
+            raise ValueError("interval_millis is needed to rate a single interval")
+        interval_millis = int(np.min(np.diff(end_times)))
+
+    matrix = VolDiffMatrix(
+        pairs=np.array(pairs, dtype=str),
+        start_times=end_times - interval_millis,
+        end_times=end_times,
+        values=np.column_stack([np.asarray(pair_dict[pair], dtype=np.float64) for pair in pairs])
+    )
+
+    return get_matrix_elos(matrix, k, initial_rating, coin_ratings)
+
+
+def get_matrix_elos(matrix, k=K_FACTOR, initial_rating=INITIAL_RATING, coin_ratings=None):
+    """ Same as get_elos for a VolDiffMatrix. Pairs missing from an
+    interval (NaN) are skipped rather than counted as draws """
+    if len(matrix.end_times) == 0 or len(matrix.pairs) == 0:
+        return []
+
+    engine = EloEngine(matrix.pairs.tolist(), k, initial_rating)
+    ratings = engine.rate(matrix.values, engine.get_initial_ratings(coin_ratings))
+
+    return [{
+        "coin": coin,
+        "start_time": start_time,
+        "end_time": end_time,
+        "elo_rating": float(rating)
+    } for start_time, end_time, interval_ratings in zip(matrix.start_times.tolist(), matrix.end_times.tolist(), ratings)
+        for coin, rating in zip(engine.coins, interval_ratings)]
+
+
+def rate_window(window, rater="legacy"):
+    """ Returns the Elo entries of a VolDiffMatrix window rated from the
+    initial ratings by elo.get_elos, or by get_elos if 'rater' is 'engine'.
+    Both are given the same pair_dict """
+    if len(window.end_times) == 0:
+        return []
+
+    pair_dict = window.to_pair_dict()
+
+    if rater == "engine":
+        return get_elos(pair_dict, int(window.end_times[0] - window.start_times[0]))
+
+    return elo.get_elos(pair_dict)
+
+
+def rate_windows(matrix, window_end_times, rater="legacy"):
+    """ Returns the Elo entries of the intervals of 'matrix' ending up to each
+    of the sorted 'window_end_times' and after the one before it, each rated
+    in the window of WINDOW_MILLIS up to its end time, as the elo_worker would
+    have rated them had it run a cycle at every one of 'window_end_times' """
+    elos = []
+    previous_end_time = None
+
+    for window_end_time in window_end_times:
+        window = matrix.select_between(window_end_time - WINDOW_MILLIS, window_end_time)
+        elos.extend(entry for entry in rate_window(window, rater)
+                    if previous_end_time is None or entry['end_time'] > previous_end_time)
+        previous_end_time = window_end_time
+
+    return elos
+
+
+class EloState(object):
+    """ Checkpoint of the latest Elo rating of every coin and the end_time of
+    the last interval whose ratings are stored, saved as JSON between
+    elo_worker cycles. Each cycle only stores the ratings of intervals after
+    'end_time', and catches up from here if it is further back than one
+    cycle """
+
+    def __init__(self, end_time=None, ratings=None, path=STATE_PATH):
+        self.end_time = end_time
+        self.ratings = ratings if ratings else {}
+        self.path = path
+
+    @classmethod
+    def load(cls, path=STATE_PATH):
+        """ Returns the saved state or an empty one if nothing is saved yet """
+        if not os.path.exists(path):
+            return cls(path=path)
+
+        with open(path) as file:
+            state = json.load(file)
+
+        return cls(state['end_time'], state['ratings'], path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with atomic_write(self.path) as file:
+            json.dump({"end_time": self.end_time, "ratings": self.ratings}, file)
+
+    def get_new_elos(self, elos):
+        """ Returns the entries of 'elos' ending after the checkpoint """
+        if self.end_time is None:
+            return list(elos)
+
+        return [entry for entry in elos if entry['end_time'] > self.end_time]
+
+    def update(self, elos):
+        """ Moves the checkpoint to the latest rating of each coin in 'elos'.
+        Coins without a rating in 'elos' keep the one they had """
+        for entry in sorted(elos, key=lambda entry: entry['end_time']):
+            self.ratings[entry['coin']] = entry['elo_rating']
+            self.end_time = entry['end_time'] if self.end_time is None else max(self.end_time, entry['end_time'])
+
+
+def check_parity(pair_dict, interval_millis=None, tolerance=PARITY_TOLERANCE):
+    """ Rates a recorded pair_dict with elo.get_elos and with get_elos and
+    returns (matched, largest difference, entries only one of them returned).
+    Ratings are compared by coin and end_time. The engine gives the same
+    ratings as elo.get_elos if every entry is matched and the largest
+    difference is at most 'tolerance' """
+    legacy_ratings = {(entry['coin'], int(entry['end_time'])): float(entry['elo_rating'])
+                      for entry in elo.get_elos(pair_dict)}
+    engine_ratings = {(entry['coin'], int(entry['end_time'])): entry['elo_rating']
+                      for entry in get_elos(pair_dict, interval_millis)}
+
+    common = legacy_ratings.keys() & engine_ratings.keys()
+    unmatched = len(legacy_ratings.keys() ^ engine_ratings.keys())
+    largest_difference = max((abs(legacy_ratings[key] - engine_ratings[key]) for key in common), default=0.0)
+
+    return unmatched == 0 and largest_difference <= tolerance, largest_difference, unmatched
+
+
+def main():
+    """ Checks the engine against elo.get_elos on a window recorded by the
+    elo_worker, or on the VolDiffMatrix .npz file given as the argument, and
+    exits with status 1 if their ratings differ """
+    path = sys.argv[1] if len(sys.argv) > 1 else RECORDING_PATH
+    matrix = VolDiffMatrix.load(path)
+
+    if len(matrix.end_times) == 0:
+        print("elo_engine: {0} holds no vol_diffs".format(path))
+        sys.exit(1)
+
+    matched, largest_difference, unmatched = check_parity(matrix.to_pair_dict(),
+                                                          int(matrix.end_times[0] - matrix.start_times[0]))
+
+    print("elo_engine: {0} intervals x {1} pairs, largest rating difference {2:.3g}, {3} unmatched entries, "
+          "K = {4}, initial rating = {5}".format(len(matrix.end_times), len(matrix.pairs), largest_difference,
+                                                  unmatched, K_FACTOR, INITIAL_RATING))
+    print("elo_engine: parity {0}".format("passed" if matched else "FAILED"))
+
+    sys.exit(0 if matched else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+ELO_COLUMNS = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`, `end_time` FROM `elo`"
+VOL_DIFF_COLUMNS = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `vol_diff` FROM `vol_diff`"
+PRICE_COLUMNS = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `open_price`, `close_price` FROM `price`"
+
+ELO_STATS_COLUMNS = "SELECT `coin`, `start_time`, `elo_rating`, `end_time`, `average_elo`, `std_dev`, \
+`lower_limit`, `upper_limit`, `moving_average` FROM `elo_stats`"
+ELO_STATS_LATEST = ELO_STATS_COLUMNS + " WHERE `end_time` = (SELECT MAX(`end_time`) FROM `elo_stats`)"
+
+# Statement name -> SQL with %s placeholders, one statement per combination of
+# filters an endpoint accepts
+STATEMENTS = {
+    "elo_since": ELO_COLUMNS + " WHERE `start_time` >= %s",
+    "elo_between": ELO_COLUMNS + " WHERE `start_time` >= %s AND `end_time` <= %s",
+    "elo_coin_since": ELO_COLUMNS + " WHERE `coin` = %s AND `start_time` >= %s",
+    "elo_coin_between": ELO_COLUMNS + " WHERE `coin` = %s AND `start_time` >= %s AND `end_time` <= %s",
+
+    "elo_stats_since": ELO_STATS_LATEST + " AND `start_time` >= %s",
+    "elo_stats_between": ELO_STATS_LATEST + " AND `start_time` >= %s AND `end_time` <= %s",
+    "elo_stats_coin_since": ELO_STATS_LATEST + " AND `coin` = %s AND `start_time` >= %s",
+    "elo_stats_coin_between": ELO_STATS_COLUMNS + " WHERE `coin` = %s AND `start_time` >= %s AND `end_time` <= %s",
+
+    "vol_diff_since": VOL_DIFF_COLUMNS + " WHERE `start_time` >= %s",
+    "vol_diff_between": VOL_DIFF_COLUMNS + " WHERE `start_time` >= %s AND `end_time` <= %s",
+    "vol_diff_pair_since": VOL_DIFF_COLUMNS + " WHERE `pair` = %s AND `start_time` >= %s",
+    "vol_diff_pair_between": VOL_DIFF_COLUMNS + " WHERE `pair` = %s AND `start_time` >= %s AND `end_time` <= %s",
+
+    "price_since": PRICE_COLUMNS + " WHERE `start_time` >= %s",
+    "price_between": PRICE_COLUMNS + " WHERE `start_time` >= %s AND `end_time` <= %s",
+    "price_pair_since": PRICE_COLUMNS + " WHERE `pair` = %s AND `start_time` >= %s",
+    "price_pair_between": PRICE_COLUMNS + " WHERE `pair` = %s AND `start_time` >= %s AND `end_time` <= %s",
+
+    "price_stats": "WITH `a` AS ( \
+SELECT `pair`, `start_time`, `end_time`, `close_price` AS `original_price`, \
+(SELECT `close_price` FROM `price` WHERE `pair` = CONCAT(%s, '-USDT') ORDER BY `end_time` DESC LIMIT 1) \
+AS `current_price` \
+FROM `price` WHERE `pair` = CONCAT(%s, '-USDT')), \
+`b` AS ( \
+SELECT `pair`, `start_time`, `end_time`, `original_price`, `current_price`, \
+(100 / `original_price`) * (`current_price` - `original_price`) AS `price_change_percent`, \
+(ROUND((UNIX_TIMESTAMP(CURTIME(4)) * 1000), 0) - `end_time`) / 60000 AS `minutes_ago` \
+FROM `a`) \
+SELECT * FROM `b` \
+WHERE `minutes_ago` <= %s \
+ORDER BY `end_time` ASC \
+LIMIT 1",
+
+    "constants_latest": "SELECT `standard_deviations`, `minutes`, `percent_change`, `pairs_per_coin`, \
+`moving_average_n` FROM `constants` ORDER BY `idconstants` DESC LIMIT 1",
+
+    "statistics_coin": "SELECT `coin`, `minutes_forward`, `slope`, `intercept`, `r`, `p`, `std_err`, \
+`change_at_3sd`, `datapoints`, `timestamp` FROM `statistics` WHERE `coin` = %s",
+    "statistics_test_coin": "SELECT `coin`, `minutes_forward`, `slope`, `intercept`, `r`, `p`, `std_err`, \
+`change_at_3sd` FROM `statistics_test` WHERE `coin` = %s"
+}
+
+
+def get_range_statement(table, key_name, key, start_time, end_time):
+    """ Returns the name and parameters of the statement filtering 'table'
+    on 'key_name' (coin or pair, skipped if 'key' is None) and a time range
+    whose end may be None """
+    if key is None and end_time is None:
+        return "{0}_since".format(table), (start_time,)
+    elif key is None:
+        return "{0}_between".format(table), (start_time, end_time)
+    elif end_time is None:
+        return "{0}_{1}_since".format(table, key_name), (key, start_time)
+    else:
+        return "{0}_{1}_between".format(table, key_name), (key, start_time, end_time)
+
+
+def execute(cursor, name, params=()):
+    """ Runs the named statement with 'params' and returns all rows. The
+    parameters are escaped by the driver so values are never formatted into
+    the SQL text by hand """
+    cursor.execute(STATEMENTS[name], params)
+
+    return cursor.fetchall()
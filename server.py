@@ -9,6 +9,10 @@ from flask_restful import reqparse
 from flaskext.mysql import MySQL
 
 import binanceapi.spot_extended
+from binanceapi import vol_diff_matrix
+from db_pool import ConnectionPool
+import queries
+import storage
 
 # load dotenv
 load_dotenv()
@@ -16,11 +20,8 @@ load_dotenv()
 mysql = MySQL()
 app = Flask(__name__)
 
-# MySQL configurations
-app.config['MYSQL_DATABASE_USER'] = os.environ.get("MYSQL_DATABASE_USER")
-app.config['MYSQL_DATABASE_PASSWORD'] = os.environ.get("MYSQL_DATABASE_PASSWORD")
-app.config['MYSQL_DATABASE_DB'] = os.environ.get("MYSQL_DATABASE_DB")
-app.config['MYSQL_DATABASE_HOST'] = os.environ.get("MYSQL_DATABASE_HOST")
+# MySQL configurations, shared with storage.connect_db
+app.config.update(storage.get_db_settings())
 
 # Binance configurations
 binance_key = os.environ.get("BINANCE_KEY")
@@ -28,9 +29,23 @@ binance_secret = os.environ.get("BINANCE_SECRET")
 
 mysql.init_app(app)
 
+# Connections are shared between requests rather than opened per request
+pool = ConnectionPool(mysql.connect, size=int(os.environ.get("MYSQL_POOL_SIZE", 10)))
+
 api = Api(app)
 
 
+def read_batch_rows(fields):
+    """ Reads the rows of a batch request, sent either as a JSON array or as
+    newline-delimited JSON, and returns them as tuples in 'fields' order """
+    if request.mimetype == 'application/x-ndjson':
+        entries = [simplejson.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    else:
+        entries = request.get_json(force=True)
+
+    return storage.get_rows(entries, fields)
+
+
 class Elo(Resource):
     """ Elo table endpoints to get and post data. SQL table used is
     `crypto_db`.`elo`. Get request queries data from SQL table and converts
@@ -49,32 +64,14 @@ class Elo(Resource):
             epoch = datetime.datetime.utcfromtimestamp(0)
             elo_start_time = int(((today - datetime.timedelta(minutes=60) - epoch).total_seconds() * 1000.0))
 
-            if request.args.get('coin') is None and request.args.get('start_time') is None and request.args.get(
-                    'end_time') is None:
+            if _start_time is None:
                 _start_time = elo_start_time
-                get_query = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`, `end_time` FROM `elo` WHERE `start_time` >= {0}".format(
-                    _start_time)
-
-            elif request.args.get('start_time') is None:
-                _start_time = elo_start_time
-
-            elif request.args.get('coin') is None:
-                get_query = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`, `end_time` \
-                FROM `elo` WHERE `start_time` >= {0} AND `end_time` <= {1}".format(_start_time, _end_time)
 
-            elif request.args.get('end_time') is None:
-                get_query = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`, `end_time` \
-                FROM `elo` WHERE `coin` = {0} AND `start_time` >= {1}".format(_coin, _start_time)
+            name, params = queries.get_range_statement('elo', 'coin', _coin, _start_time, _end_time)
 
-            else:
-                get_query = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`, `end_time` \
-                FROM `elo` WHERE `coin` = {0} AND `start_time` >= {1} AND \
-                `end_time` <= {2}".format(_coin, _start_time, _end_time)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, name, params)
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -106,25 +103,43 @@ class Elo(Resource):
             _end_time = args['end_time']
             _elo_rating = args['elo_rating']
 
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.callproc('spInsertElo', (_coin, _start_time, _elo_rating, _end_time))
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.callproc('spInsertElo', (_coin, _start_time, _elo_rating, _end_time))
+                    data = cursor.fetchall()
+
+                    if len(data) is 0:
+                        storage.refresh_intervals(cursor, ('spRefreshEloStats', 'spRefreshPriceEloFact'), [_end_time])
+                        conn.commit()
+                        return {'statusCode': '200', 'message': 'Elo entry inserted'}
+                    else:
+                        return {'statusCode': '1000', 'message': str(data[0])}
+
+        except Exception as e:
+            return {'error': str(e)}
 
-            if len(data) is 0:
-                conn.commit()
-                return {'statusCode': '200', 'message': 'Elo entry inserted'}
-            else:
-                return {'statusCode': '1000', 'message': str(data[0])}
+
+class EloBatch(Resource):
+    """ Batch insert endpoint for `crypto_db`.`elo`. Post request takes a
+    list of Elo entries and inserts the ones whose (`coin`, `end_time`) is not
+    already in the table. Ratings already stored are kept """
+
+    def post(self):
+        try:
+            rows = read_batch_rows(storage.ELO_FIELDS)
+            count = storage.store_elos(pool, rows)
+
+            return {'statusCode': '200', 'message': '{0} Elo entries inserted'.format(count)}
 
         except Exception as e:
             return {'error': str(e)}
 
 
 class EloStats(Resource):
-    """ Elo statistics endpoint to get data from SQL table `crypto_db`.`elo` via
-    view `crypto_db`.`elo_stats`. Get request queries data and converts
-    data to a dictionary """
+    """ Elo statistics endpoint to get data from SQL table
+    `crypto_db`.`elo_stats`, which is refreshed whenever an interval of Elo
+    ratings is posted. Without a coin and end time only the latest interval is
+    returned. Get request queries data and converts data to a dictionary """
 
     def get(self):
         try:
@@ -139,84 +154,14 @@ class EloStats(Resource):
             epoch = datetime.datetime.utcfromtimestamp(0)
             elo_start_time = int(((today - datetime.timedelta(minutes=6000) - epoch).total_seconds() * 1000.0))
 
-            if request.args.get('coin') is None and request.args.get('start_time') is None and request.args.get(
-                    'end_time') is None:
-                _start_time = elo_start_time
-                get_query = "with `f` as (\
-                            select * from elo_stats_2) \
-                            select distinct	`f`.`coin`,\
-                                    `f`.`start_time`,\
-                                    `f`.`elo_rating`,\
-                                    `f`.`end_time`,\
-                                    `e`.`average_elo`,\
-                                    `e`.`std_dev`,\
-                                    `e`.`lower_limit`,\
-                                    `e`.`upper_limit`,\
-                                    `f`.`moving_average`\
-                            from `f`\
-                            join `elo_stats` `e`\
-                            on `e`.`end_time` = `f`.`end_time`\
-                            and `e`.`coin` = `f`.`coin`\
-                            where `e`.`end_time` = \
-                            (select `end_time` from `elo` order by `end_time` desc limit 1)\
-                            and `f`.`start_time` >= {0}".format(_start_time)
-
-            elif request.args.get('start_time') is None:
+            if _start_time is None:
                 _start_time = elo_start_time
 
-            elif request.args.get('coin') is None:
-                get_query = "with `f` as (\
-                            select * from elo_stats_2) \
-                            select distinct	`f`.`coin`,\
-                                    `f`.`start_time`,\
-                                    `f`.`elo_rating`,\
-                                    `f`.`end_time`,\
-                                    `e`.`average_elo`,\
-                                    `e`.`std_dev`,\
-                                    `e`.`lower_limit`,\
-                                    `e`.`upper_limit`,\
-                                    `f`.`moving_average`\
-                            from `f`\
-                            join `elo_stats` `e`\
-                            on `e`.`end_time` = `f`.`end_time`\
-                            and `e`.`coin` = `f`.`coin`\
-                            where `e`.`end_time` = \
-                            (select `end_time` from `elo` order by `end_time` desc limit 1)\
-                             and `f`.`start_time` >= {0} \
-                 AND `f`.`end_time` <= {1}".format(_start_time, _end_time)
-
-            elif request.args.get('end_time') is None:
-                get_query = "with `f` as (\
-                            select * from elo_stats_2) \
-                            select distinct	`f`.`coin`,\
-                                    `f`.`start_time`,\
-                                    `f`.`elo_rating`,\
-                                    `f`.`end_time`,\
-                                    `e`.`average_elo`,\
-                                    `e`.`std_dev`,\
-                                    `e`.`lower_limit`,\
-                                    `e`.`upper_limit`,\
-                                    `f`.`moving_average`\
-                            from `f`\
-                            join `elo_stats` `e`\
-                            on `e`.`end_time` = `f`.`end_time`\
-                            and `e`.`coin` = `f`.`coin`\
-                            where `e`.`end_time` = \
-                            (select `end_time` from `elo` order by `end_time` desc limit 1)\
-                             and `f`.`coin` = {0} \
-                 AND `f`.`start_time` >= {1}".format(_coin, _start_time)
+            name, params = queries.get_range_statement('elo_stats', 'coin', _coin, _start_time, _end_time)
 
-            else:
-                get_query = "SELECT DISTINCT `coin`, `start_time`, `elo_rating`,\
-                 `end_time`, `average_elo`, `std_dev`, `lower_limit`, \
-                 `upper_limit`, `moving_average` FROM `elo_stats` WHERE `coin` = {0} AND \
-                 `start_time` >= {1} AND \
-                `end_time` <= {2}".format(_coin, _start_time, _end_time)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, name, params)
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -246,14 +191,9 @@ class Constants(Resource):
 
     def get(self):
         try:
-            get_query = "SELECT `standard_deviations`, `minutes`,               \
-            `percent_change`, `pairs_per_coin`, `moving_average_n` FROM `constants` order by `idconstants`    \
-            desc limit 1"
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, 'constants_latest')
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -281,13 +221,9 @@ class StatisticsTest(Resource):
         try:
             _coin = request.args.get('coin')
 
-            get_query = f"SELECT `coin`, `minutes_forward`, `slope`, `intercept`, `r`, `p`, `std_err`,  \
-                            `change_at_3sd` FROM `statistics_test` WHERE `coin` = '{0}'".format(_coin)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, 'statistics_test_coin', (_coin,))
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -323,18 +259,18 @@ class StatisticsTest(Resource):
             _std_err = args['std_err']
             _change_at_3sd = args['change_at_3sd']
 
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.callproc('spInsertStatisticsTest', (_coin, _minutes_forward,
-                                                   _slope, _intercept, _r_value,
-                                                   _p_value, _std_err, _change_at_3sd))
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.callproc('spInsertStatisticsTest', (_coin, _minutes_forward,
+                                                           _slope, _intercept, _r_value,
+                                                           _p_value, _std_err, _change_at_3sd))
+                    data = cursor.fetchall()
 
-            if len(data) is 0:
-                conn.commit()
-                return {'statusCode': '200', 'message': 'Statistics entry inserted'}
-            else:
-                return {'statusCode': '1000', 'message': str(data[0])}
+                    if len(data) is 0:
+                        conn.commit()
+                        return {'statusCode': '200', 'message': 'Statistics entry inserted'}
+                    else:
+                        return {'statusCode': '1000', 'message': str(data[0])}
 
         except Exception as e:
             return {'error': str(e)}
@@ -351,13 +287,9 @@ class Statistics(Resource):
         try:
             _coin = request.args.get('coin')
 
-            get_query = f"SELECT `coin`, `minutes_forward`, `slope`, `intercept`, `r`, `p`, `std_err`,  \
-                        `change_at_3sd` FROM `statistics` WHERE `coin` = '{0}'".format(_coin)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, 'statistics_coin', (_coin,))
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -398,24 +330,56 @@ class Statistics(Resource):
             _datapoints = args['datapoints']
             _timestamp = args['timestamp']
 
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.callproc('spInsertStatistics', (_coin, _minutes_forward,
-                                                   _slope, _intercept, _r_value,
-                                                   _p_value, _std_err, _change_at_3sd,
-                                                   _datapoints, _timestamp))
-            data = cursor.fetchall()
-
-            if len(data) is 0:
-                conn.commit()
-                return {'statusCode': '200', 'message': 'Statistics entry inserted'}
-            else:
-                return {'statusCode': '1000', 'message': str(data[0])}
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.callproc('spInsertStatistics', (_coin, _minutes_forward,
+                                                           _slope, _intercept, _r_value,
+                                                           _p_value, _std_err, _change_at_3sd,
+                                                           _datapoints, _timestamp))
+                    data = cursor.fetchall()
+
+                    if len(data) is 0:
+                        conn.commit()
+                        return {'statusCode': '200', 'message': 'Statistics entry inserted'}
+                    else:
+                        return {'statusCode': '1000', 'message': str(data[0])}
 
         except Exception as e:
             return {'error': str(e)}
 
 
+class StatisticsBatch(Resource):
+    """ Batch insert endpoint for `crypto_db`.`statistics`. Post request takes
+    a list of statistics entries, one per coin and minutes forward, and upserts
+    them on (`coin`, `minutes_forward`, `timestamp`) """
+
+    def post(self):
+        try:
+            rows = read_batch_rows(('coin', 'minutes_forward', 'slope', 'intercept', 'r_value', 'p_value',
+                                    'std_err', 'change_at_3sd', 'datapoints', 'timestamp'))
+            count = storage.upsert_rows(pool, 'statistics',
+                                        ('coin', 'minutes_forward', 'slope', 'intercept', 'r', 'p', 'std_err',
+                                         'change_at_3sd', 'datapoints', 'timestamp'),
+                                        ('slope', 'intercept', 'r', 'p', 'std_err', 'change_at_3sd', 'datapoints'),
+                                        rows)
+
+            return {'statusCode': '200', 'message': '{0} Statistics entries inserted'.format(count)}
+
+        except Exception as e:
+            return {'error': str(e)}
+
+
+def get_vol_diff_start_time():
+    """ Returns the default start time of the vol_diff endpoints, an hour
+    before Binance's current time """
+    binance_api = binanceapi.spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
+    today = datetime.datetime.utcfromtimestamp(binance_api.get_current_timestamp() / 1000).replace(second=0,
+                                                                                                   microsecond=0)
+    epoch = datetime.datetime.utcfromtimestamp(0)
+
+    return int(((today - datetime.timedelta(minutes=60) - epoch).total_seconds() * 1000.0))
+
+
 class VolDiff(Resource):
     """ Volume difference endpoint to get data from SQL table
     `crypto_db`.`vol_diff`. Get request queries data and converts data to a
@@ -427,40 +391,14 @@ class VolDiff(Resource):
             _start_time = request.args.get('start_time')
             _pair = request.args.get('pair')
 
-            binance_api = binanceapi.spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
-            today = datetime.datetime.utcfromtimestamp(binance_api.get_current_timestamp() / 1000).replace(second=0,
-                                                                                                           microsecond=0)
-            millis_in_min = 1000 * 60
-            epoch = datetime.datetime.utcfromtimestamp(0)
-            vol_diff_start_time = int(((today - datetime.timedelta(minutes=60) - epoch).total_seconds() * 1000.0))
-
-            if request.args.get('pair') is None and request.args.get('start_time') is None and request.args.get(
-                    'end_time') is None:
-                _start_time = vol_diff_start_time
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `vol_diff` FROM `vol_diff` WHERE `start_time` >= {0}".format(
-                    _start_time)
-
-            elif request.args.get('start_time') is None:
-                _start_time = vol_diff_start_time
+            if _start_time is None:
+                _start_time = get_vol_diff_start_time()
 
-            elif request.args.get('pair') is None:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `vol_diff` \
-                FROM `vol_diff` WHERE `start_time` >= {0} AND `end_time` <= {1}".format(_start_time, _end_time)
+            name, params = queries.get_range_statement('vol_diff', 'pair', _pair, _start_time, _end_time)
 
-            elif request.args.get('end_time') is None:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `vol_diff` \
-                FROM `vol_diff` WHERE `pair` = {0} AND `start_time` >= {1}".format(_pair, _start_time)
-
-            else:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `vol_diff` \
-                FROM `vol_diff` WHERE `pair` = {0} AND `start_time` >= {1} AND \
-                `end_time` <= {2}".format(_pair, _start_time, _end_time)
-
-            # print(get_query)
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, name, params)
             json_data = simplejson.loads(simplejson.dumps(data))
             # print(json_data)
             dict_list = []
@@ -494,16 +432,73 @@ class VolDiff(Resource):
             _end_time = args['end_time']
             _vol_diff = args['vol_diff']
 
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.callproc('spInsertVolDiff', (_pair, _start_time, _end_time, _vol_diff))
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.callproc('spInsertVolDiff', (_pair, _start_time, _end_time, _vol_diff))
+                    data = cursor.fetchall()
 
-            if len(data) is 0:
-                conn.commit()
-                return {'statusCode': '200', 'message': 'VolDiff entry inserted'}
-            else:
-                return {'statusCode': '1000', 'message': str(data[0])}
+                    if len(data) is 0:
+                        conn.commit()
+                        return {'statusCode': '200', 'message': 'VolDiff entry inserted'}
+                    else:
+                        return {'statusCode': '1000', 'message': str(data[0])}
+
+        except Exception as e:
+            return {'error': str(e)}
+
+
+class VolDiffBatch(Resource):
+    """ Batch insert endpoint for `crypto_db`.`vol_diff`. Post request takes a
+    list of volume difference entries and upserts them on (`pair`, `end_time`) """
+
+    def post(self):
+        try:
+            rows = read_batch_rows(storage.VOL_DIFF_FIELDS)
+            count = storage.store_vol_diffs(pool, rows)
+
+            return {'statusCode': '200', 'message': '{0} VolDiff entries inserted'.format(count)}
+
+        except Exception as e:
+            return {'error': str(e)}
+
+
+class VolDiffMatrix(Resource):
+    """ Volume differences of `crypto_db`.`vol_diff` as a VolDiffMatrix
+    payload (see VolDiffMatrix.to_api). Get request takes the same arguments
+    as /VolDiff plus 'dtype' (float32 or float64) and post request upserts a
+    matrix on (`pair`, `end_time`). backfill reads the vol_diffs it rates from
+    here """
+
+    def get(self):
+        try:
+            _end_time = request.args.get('end_time')
+            _start_time = request.args.get('start_time')
+            _pair = request.args.get('pair')
+            _dtype = request.args.get('dtype', 'float64')
+
+            if _dtype not in vol_diff_matrix.API_DTYPES:
+                return {'error': 'dtype must be one of {0}'.format(", ".join(vol_diff_matrix.API_DTYPES))}
+
+            if _start_time is None:
+                _start_time = get_vol_diff_start_time()
+
+            name, params = queries.get_range_statement('vol_diff', 'pair', _pair, _start_time, _end_time)
+
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, name, params)
+
+            return vol_diff_matrix.VolDiffMatrix.from_rows(data).to_api(_dtype)
+
+        except Exception as e:
+            return {'error': str(e)}
+
+    def post(self):
+        try:
+            matrix = vol_diff_matrix.VolDiffMatrix.from_api(request.get_json(force=True))
+            count = storage.store_vol_diffs(pool, matrix.to_rows())
+
+            return {'statusCode': '200', 'message': '{0} VolDiff entries inserted'.format(count)}
 
         except Exception as e:
             return {'error': str(e)}
@@ -519,50 +514,9 @@ class PriceStats(Resource):
             _pair = request.args.get('pair')
             _minutes = request.args.get('minutes')
 
-            get_query = "WITH B AS (                                        \
-	WITH A AS (                                                            \
-		SELECT `pair`,                                                        \
-				`start_time`,                                                   \
-				`end_time`,                                                     \
-				`open_price`,                                                   \
-				`close_price`,                                                  \
-				(SELECT `close_price`                                           \
-				FROM `crypto_db`.`price`                                        \
-				WHERE `pair` = \"{0}-USDT\"                                     \
-				ORDER BY `end_time` DESC                                        \
-				LIMIT 1) AS `current_price`                                     \
-		FROM `crypto_db`.`price`                                                  \
-		WHERE `pair` = \"{0}-USDT\"                                           \
-		ORDER BY `end_time` DESC)                                             \
-                                                                            \
-	SELECT 	`pair`,                                                            \
-			`start_time`,                                                    \
-			`end_time`,                                                      \
-			`open_price`,                                                    \
-			`close_price` AS `original_price`,                                 \
-			`current_price`,                                                     \
-			(100 / `close_price`) * (`current_price` - `close_price`) as     \
-            `price_change_percent`,                                             \
-			(round((unix_timestamp(curtime(4)) * 1000),0) - `end_time`) /    \
-            60000 as `minutes_ago`                                              \
-	FROM A)                                                                    \
-                                                                                \
-SELECT 	`pair`,                                                                \
-		`start_time`,                                                         \
-		`end_time`,                                                           \
-		`original_price`,                                    \
-		`current_price`,                                                      \
-        `price_change_percent`,                                                 \
-        `minutes_ago`                                                           \
-FROM B                                                                          \
-WHERE `minutes_ago` <= {1}                                                      \
-ORDER BY `end_time` ASC                                                         \
-LIMIT 1".format(_pair, _minutes)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, 'price_stats', (_pair, _pair, _minutes))
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             if len(json_data) > 0:
@@ -604,32 +558,14 @@ class Price(Resource):
             epoch = datetime.datetime.utcfromtimestamp(0)
             price_start_time = int(((today - datetime.timedelta(minutes=60) - epoch).total_seconds() * 1000.0))
 
-            if request.args.get('pair') is None and request.args.get('start_time') is None and request.args.get(
-                    'end_time') is None:
+            if _start_time is None:
                 _start_time = price_start_time
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `open_price`, `close_price` FROM `price` WHERE `start_time` >= {0}".format(
-                    _start_time)
 
-            elif request.args.get('start_time') is None:
-                _start_time = price_start_time
+            name, params = queries.get_range_statement('price', 'pair', _pair, _start_time, _end_time)
 
-            elif request.args.get('pair') is None:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `open_price`, `close_price` \
-                FROM `price` WHERE `start_time` >= {0} AND `end_time` <= {1}".format(_start_time, _end_time)
-
-            elif request.args.get('end_time') is None:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `open_price`, `close_price` \
-                FROM `price` WHERE `pair` = {0} AND `start_time` >= {1}".format(_pair, _start_time)
-
-            else:
-                get_query = "SELECT DISTINCT `pair`, `start_time`, `end_time`, `open_price`, `close_price` \
-                FROM `price` WHERE `pair` = {0} AND `start_time` >= {1} AND \
-                `end_time` <= {2}".format(_pair, _start_time, _end_time)
-
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.execute(get_query)
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    data = queries.execute(cursor, name, params)
             json_data = simplejson.loads(simplejson.dumps(data))
             dict_list = []
             for entry in json_data:
@@ -664,16 +600,45 @@ class Price(Resource):
             _open_price = args['open_price']
             _close_price = args['close_price']
 
-            conn = mysql.connect()
-            cursor = conn.cursor()
-            cursor.callproc('spInsertPrice', (_pair, _start_time, _end_time, _open_price, _close_price))
-            data = cursor.fetchall()
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.callproc('spInsertPrice', (_pair, _start_time, _end_time, _open_price, _close_price))
+                    data = cursor.fetchall()
 
-            if len(data) is 0:
-                conn.commit()
-                return {'statusCode': '200', 'message': 'Price entry inserted'}
-            else:
-                return {'statusCode': '1000', 'message': str(data[0])}
+                    if len(data) is 0:
+                        # Elo intervals end 1ms after the candle they are matched with
+                        storage.refresh_intervals(cursor, ('spRefreshPriceEloFact',), [_end_time + 1])
+                        conn.commit()
+                        return {'statusCode': '200', 'message': 'Price entry inserted'}
+                    else:
+                        return {'statusCode': '1000', 'message': str(data[0])}
+
+        except Exception as e:
+            return {'error': str(e)}
+
+
+class PriceBatch(Resource):
+    """ Batch insert endpoint for `crypto_db`.`price`. Post request takes a
+    list of price entries and upserts them on (`pair`, `end_time`) """
+
+    def post(self):
+        try:
+            rows = read_batch_rows(storage.PRICE_FIELDS)
+            count = storage.store_prices(pool, rows)
+
+            return {'statusCode': '200', 'message': '{0} Price entries inserted'.format(count)}
+
+        except Exception as e:
+            return {'error': str(e)}
+
+
+class PoolStats(Resource):
+    """ Connection pool endpoint to get the checkout, wait and health check
+    counters of the MySQL connection pool """
+
+    def get(self):
+        try:
+            return pool.get_stats()
 
         except Exception as e:
             return {'error': str(e)}
@@ -681,13 +646,19 @@ class Price(Resource):
 
 # Assign endpoints
 api.add_resource(VolDiff, '/VolDiff')
+api.add_resource(VolDiffBatch, '/VolDiff/Batch')
+api.add_resource(VolDiffMatrix, '/VolDiff/Matrix')
 api.add_resource(Elo, '/Elo')
+api.add_resource(EloBatch, '/Elo/Batch')
 api.add_resource(EloStats, '/EloStats')
 api.add_resource(Price, '/Price')
+api.add_resource(PriceBatch, '/Price/Batch')
 api.add_resource(PriceStats, '/PriceStats')
 api.add_resource(Constants, '/Constants')
 api.add_resource(Statistics, '/Statistics')
+api.add_resource(StatisticsBatch, '/Statistics/Batch')
 api.add_resource(StatisticsTest, '/StatisticsTest')
+api.add_resource(PoolStats, '/PoolStats')
 
 # def run_server(host, port, debug, threaded):
 app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
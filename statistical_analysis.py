@@ -3,12 +3,14 @@ import multiprocessing as mp
 import os
 import socket
 import time
+from multiprocessing import shared_memory
 
 import matplotlib.pyplot as plt
 import mysql.connector
+import numpy as np
 import pandas as pd
 import requests
-import scipy
+import scipy.stats
 import seaborn as sns
 import simplejson
 from dotenv import load_dotenv
@@ -16,7 +18,8 @@ from pycoingecko import CoinGeckoAPI
 
 import binanceapi.spot_extended
 import urls as u
-from correlation_statistics import CorrelationStatistics as cs
+from correlation_statistics import STORE_PATH, CorrelationStatisticsStore
+from statistics_cache import StatisticsCache
 from utilities import log_error
 
 # load dotenv
@@ -35,6 +38,27 @@ binance_secret = os.environ.get("BINANCE_SECRET")
 binance_api = binanceapi.spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
 
 
+def connect_db():
+    return mysql.connector.connect(
+        host=os.environ.get("MYSQL_DATABASE_HOST"),
+        user=os.environ.get("MYSQL_DATABASE_USER"),
+        password=os.environ.get("MYSQL_DATABASE_PASSWORD"),
+        database=os.environ.get("MYSQL_DATABASE_DB")
+    )
+
+
+statistics_cache = StatisticsCache(connect_db, ttl=int(os.environ.get("STATISTICS_CACHE_TTL", 60)))
+
+# Correlation statistics store and the modification time of its file when it
+# was loaded, see get_correlation_store
+correlation_store = None
+correlation_store_mtime = None
+
+MILLIS_IN_MIN = 1000 * 60
+# Minutes forward the price change is regressed against the Elo deviation for
+LAGS = np.arange(2, 63)
+
+
 def show_change_at_3sds():
     constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
     pairs_per_coin_limit = int(constants['pairs_per_coin'])
@@ -82,7 +106,227 @@ def show_change_at_3sds():
         plt.show()
 
 
-def analyse():
+def load_coin_series(db, coin):
+    """ Reads a coin's moving average Elo deviations and close prices from
+    `crypto_db`.`price_elo_fact` in one query and lays them out on a minute
+    grid starting at the first interval, NaN where there is no interval. The
+    price 'n' minutes after grid point i is then simply index i + n """
+    cursor = db.cursor()
+    cursor.execute("SELECT `end_time`, `moving_average_deviation`, `close_price` \
+    FROM `crypto_db`.`price_elo_fact` \
+    WHERE `coin` = %s \
+    ORDER BY `end_time`", (coin,))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+    cursor.close()
+
+    if len(rows) == 0:
+        return np.empty(0), np.empty(0)
+
+    minutes = ((rows[:, 0] - rows[0, 0]) // MILLIS_IN_MIN).astype(np.int64)
+    deviations = np.full(minutes[-1] + 1, np.nan)
+    close_prices = np.full(minutes[-1] + 1, np.nan)
+    deviations[minutes] = rows[:, 1]
+    close_prices[minutes] = rows[:, 2]
+
+    return deviations, close_prices
+
+
+def regress_lags(deviations, close_prices, lags, max_cells=2 ** 22):
+    """ Regresses the percent price change 'lag' minutes ahead against the
+    Elo deviation for every lag at once and returns arrays (one entry per lag)
+    of the same values scipy.stats.linregress gives. Forward prices for all
+    lags are strided views over the price array, pairs where either side is
+    missing are masked out of the sums. Lags are processed in blocks of at most
+    'max_cells' values to bound memory on long histories """
+    lags = np.asarray(lags)
+    size = len(close_prices)
+    padded_prices = np.concatenate([close_prices, np.full(int(lags.max()), np.nan)])
+    # forward_prices[j, i] is padded_prices[i + j] without copying
+    forward_prices = np.lib.stride_tricks.sliding_window_view(padded_prices, size) if size > 0 else None
+
+    lag_stats = {name: np.full(len(lags), np.nan) for name in
+                 ('slope', 'intercept', 'r_value', 'p_value', 'std_err', 'change_at_3sd')}
+    lag_stats['datapoints'] = np.zeros(len(lags), dtype=np.int64)
+
+    if size == 0:
+        return lag_stats
+
+    block_size = max(1, max_cells // size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(lags), block_size):
+            block = slice(start, start + block_size)
+            x = deviations[np.newaxis, :]
+            y = (forward_prices[lags[block]] * 100 / close_prices) - 100
+
+            mask = np.isfinite(x) & np.isfinite(y)
+            n = mask.sum(axis=1)
+            x = np.where(mask, x, 0.0)
+            y = np.where(mask, y, 0.0)
+
+            x_mean = x.sum(axis=1) / n
+            y_mean = y.sum(axis=1) / n
+            x_dev = np.where(mask, x - x_mean[:, np.newaxis], 0.0)
+            y_dev = np.where(mask, y - y_mean[:, np.newaxis], 0.0)
+            sxx = (x_dev * x_dev).sum(axis=1)
+            syy = (y_dev * y_dev).sum(axis=1)
+            sxy = (x_dev * y_dev).sum(axis=1)
+
+            slope = sxy / sxx
+            intercept = y_mean - slope * x_mean
+            r_value = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0)
+            dof = n - 2
+            t_stat = r_value * np.sqrt(dof / ((1.0 - r_value) * (1.0 + r_value)))
+            p_value = 2 * scipy.stats.t.sf(np.abs(t_stat), dof)
+            std_err = np.sqrt((1 - r_value ** 2) * syy / sxx / dof)
+
+            lag_stats['slope'][block] = slope
+            lag_stats['intercept'][block] = intercept
+            lag_stats['r_value'][block] = r_value
+            lag_stats['p_value'][block] = p_value
+            lag_stats['std_err'][block] = std_err
+            lag_stats['change_at_3sd'][block] = (3 * slope) + intercept
+            lag_stats['datapoints'][block] = n
+
+    return lag_stats
+
+
+def get_coin_stats(coin, lag_stats, timestamp):
+    """ Converts the regress_lags arrays of a coin into Statistics entries,
+    skipping lags with too few datapoints for a regression """
+    coin_stats = []
+
+    for i in np.flatnonzero(lag_stats['datapoints'] > 2):
+        coin_stats.append({
+            'coin': coin,
+            'minutes_forward': int(LAGS[i]),
+            'slope': float(lag_stats['slope'][i]),
+            'intercept': float(lag_stats['intercept'][i]),
+            'r_value': float(lag_stats['r_value'][i]),
+            'p_value': float(lag_stats['p_value'][i]),
+            'std_err': float(lag_stats['std_err'][i]),
+            'change_at_3sd': float(lag_stats['change_at_3sd'][i]),
+            'datapoints': int(lag_stats['datapoints'][i]),
+            'timestamp': timestamp
+        })
+
+    return coin_stats
+
+
+# Series shared with the regression workers, set by attach_series
+shared_series = None
+
+
+def attach_series(shm_name, size):
+    """ Process pool initializer mapping the shared deviations and close
+    prices of every coin, see share_series """
+    global shared_series
+    shm = shared_memory.SharedMemory(name=shm_name)
+    values = np.ndarray((2, size), dtype=np.float64, buffer=shm.buf)
+    values.flags.writeable = False
+    shared_series = (shm, values)
+
+
+def share_series(series):
+    """ Copies the series of all coins end to end into one shared memory block
+    (deviations in row 0, close prices in row 1) and returns the block along
+    with each coin's (start, stop) columns """
+    size = max(1, sum(len(close_prices) for deviations, close_prices in series.values()))
+    shm = shared_memory.SharedMemory(create=True, size=2 * size * np.dtype(np.float64).itemsize)
+    values = np.ndarray((2, size), dtype=np.float64, buffer=shm.buf)
+
+    offsets = {}
+    start = 0
+    for coin, (deviations, close_prices) in series.items():
+        stop = start + len(close_prices)
+        values[0, start:stop] = deviations
+        values[1, start:stop] = close_prices
+        offsets[coin] = (start, stop)
+        start = stop
+
+    return shm, size, offsets
+
+
+def regress_shared_coin(task):
+    """ Runs the regression sweep of one coin on its slice of the shared
+    series inside a pool worker """
+    coin, start, stop = task
+    values = shared_series[1]
+
+    return coin, regress_lags(values[0, start:stop], values[1, start:stop], LAGS)
+
+
+def regress_coins(series, pool_size):
+    """ Returns coin -> regress_lags arrays for every coin in 'series'. With a
+    pool size above 1 the coins are spread over a process pool which reads
+    the series from shared memory rather than having them pickled per task """
+    coins = [coin for coin in series if len(series[coin][1]) > 0]
+
+    if pool_size <= 1 or len(coins) <= 1:
+        return {coin: regress_lags(*series[coin], LAGS) for coin in coins}
+
+    shm, size, offsets = share_series(series)
+
+    try:
+        tasks = [(coin, *offsets[coin]) for coin in coins]
+        with mp.Pool(min(pool_size, len(tasks)), initializer=attach_series, initargs=(shm.name, size)) as pool:
+            return dict(pool.imap_unordered(regress_shared_coin, tasks))
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def draw_correlation_chart(coin, deviations, close_prices, strongest_minute, rows, timestamp_string):
+    """ Plots the price change 'strongest_minute' minutes ahead against the
+    Elo deviation from the series already loaded for the regression """
+    x_array = deviations[:-strongest_minute]
+    y_array = (close_prices[strongest_minute:] * 100 / close_prices[:-strongest_minute]) - 100
+    mask = np.isfinite(x_array) & np.isfinite(y_array)
+    x_array = x_array[mask]
+    y_array = y_array[mask]
+    datapoints = x_array.size
+
+    if datapoints < 3:
+        return
+
+    slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x_array, y_array)
+    change_at_3sd = (3 * slope) + intercept
+
+    fig2, ax = plt.subplots(figsize=(15, 15))
+
+    regplot = sns.regplot(
+        x=x_array,
+        y=y_array,
+        ax=ax,
+        line_kws={
+            'label': "ΔPrice(%) = {0:.2E}*(Elo-μ)/σ + {1:.2E},\nr = {2:.2E}, p = {3:.2E}, @3sd = {4:.2f}%".format(
+                slope,
+                intercept,
+                r_value,
+                p_value,
+                change_at_3sd)}
+    )
+    plt.title("{0} at {1} with {2} datapoints".format(coin, timestamp_string, datapoints))
+    plt.xlabel('{0} Point Moving Average Elo Rating Deviations at Time t0'.format(rows))
+    plt.ylabel('Price Change % {0} Minutes After t0 /USDT'.format(strongest_minute))
+    ax.set_xlim(-3, 3)
+    ax.set_ylim(-1.5, 1.5)
+
+    regplot.legend()
+
+    plt.savefig("Charts/Correlations/Correlation_Chart_Test_{1}_Point_Moving_Average_{0}.png".format(coin, rows))
+    plt.close(fig2)
+
+
+def analyse(pool_size=None):
+    """ Regresses each coin's price change against its Elo deviation for every
+    lag in LAGS, posts the results to the Statistics endpoint in one batch and
+    charts each coin at its strongest lag. The regressions run in a pool of
+    'pool_size' processes (STATISTICS_POOL_SIZE or the CPU count by default,
+    1 to run them in this process) """
+    if pool_size is None:
+        pool_size = int(os.environ.get("STATISTICS_POOL_SIZE", os.cpu_count() or 1))
 
     while True:
 
@@ -111,177 +355,107 @@ def analyse():
 
         print("Starting stats worker")
 
+        series = {}
         for coin in coins:
-            print(coin)
-            for minute in range(2, 63):
-                print(minute)
-                _df = pd.DataFrame([])
-
-                try:
-                    query = f"SELECT a.coin, a.elo_rating, a.x_point_moving_average \
-                    as x_point_moving_average_rating, \
-                    (a.elo_rating - a.average_elo) / a.std_dev as elo_deviations,\
-                            avg((a.elo_rating - a.average_elo) / a.std_dev) OVER (PARTITION \
-                    BY a.coin ORDER BY a.end_time DESC ROWS BETWEEN {rows - 1} \
-                    PRECEDING AND CURRENT ROW) AS \
-                    `x_point_moving_average_deviations`,\
-                    a.end_time as original_time,\
-                    a.close_price as original_price,\
-                    b.close_price as projected_price,\
-                    (b.close_price * 100 / a.close_price) - 100 as \
-                    price_change_percent,\
-                    b.end_time as projected_time,\
-                    (b.end_time - a.end_time) / 60000 as minutes_forward\
-                    FROM crypto_db.price_elo_stats a\
-                    join crypto_db.price_elo_stats b\
-                    on (a.end_time + (60000 * {minute})) = b.end_time\
-                    where a.coin = '{coin}'\
-                    and b.coin = '{coin}'\
-                    order by a.end_time desc"
-
-                    # print(query)
-
-                    df = pd.read_sql(query, db)
-
-                    # print(df)
-
-                    x_array = df['x_point_moving_average_deviations'].to_numpy()
-                    y_array = df['price_change_percent'].to_numpy()
-
-                    slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x_array, y_array)
-                    change_at_3sd = (3 * slope) + intercept
-                    datapoints = int(x_array.size)
-                    stats = {
-                        'coin': coin,
-                        'minutes_forward': minute,
-                        'slope': slope,
-                        'intercept': intercept,
-                        'r_value': r_value,
-                        'p_value': p_value,
-                        'std_err': std_err,
-                        'change_at_3sd': change_at_3sd,
-                        'datapoints': datapoints,
-                        'timestamp': timestamp
-                    }
-
-                except Exception as e:
-                    log_error(e)
+            try:
+                series[coin] = load_coin_series(db, coin)
+            except Exception as e:
+                log_error(e)
 
-        for coin in coins:
+        db.close()
+
+        coin_lag_stats = {}
+        try:
+            coin_lag_stats = regress_coins(series, pool_size)
+        except Exception as e:
+            log_error(e)
+
+        statistics = []
+        for coin, lag_stats in coin_lag_stats.items():
+            statistics.extend(get_coin_stats(coin, lag_stats, timestamp))
+
+        try:
+            response = requests.post(url=urls.STATISTICS_BATCH, json=statistics)
+            response.raise_for_status()
+
+            # The server reports errors in the body with a 200 status
+            body = response.json()
+            if 'error' in body:
+                raise Exception(body['error'])
+
+            statistics_cache.invalidate()
+        except Exception as e:
+            log_error(e)
+
+        try:
+            # Rows of other moving average lengths and coins not analysed in
+            # this run are kept
+            stored_statistics = CorrelationStatisticsStore.load()
+            stored_statistics.merge(CorrelationStatisticsStore.from_statistics(statistics, rows)).save()
+        except Exception as e:
+            log_error(e)
+
+        for coin, lag_stats in coin_lag_stats.items():
             print(coin)
-            strongest_minute = read_coin_stats(coin).strongest_minute
+            if np.all(np.isnan(lag_stats['p_value'])):
+                continue
+
+            # Lag with the most significant correlation
+            strongest_minute = int(LAGS[np.nanargmin(lag_stats['p_value'])])
             print(strongest_minute)
 
-            fig2, ax = plt.subplots(figsize=(15, 15))
-
-            query = f"SELECT a.coin, a.elo_rating, a.x_point_moving_average \
-                                as x_point_moving_average_rating, \
-                                (a.elo_rating - a.average_elo) / a.std_dev as elo_deviations,\
-                                        avg((a.elo_rating - a.average_elo) / a.std_dev) OVER (PARTITION \
-                                BY a.coin ORDER BY a.end_time DESC ROWS BETWEEN {rows - 1} \
-                                PRECEDING AND CURRENT ROW) AS \
-                                `x_point_moving_average_deviations`,\
-                                a.end_time as original_time,\
-                                a.close_price as original_price,\
-                                b.close_price as projected_price,\
-                                (b.close_price * 100 / a.close_price) - 100 as \
-                                price_change_percent,\
-                                b.end_time as projected_time,\
-                                (b.end_time - a.end_time) / 60000 as minutes_forward\
-                                FROM crypto_db.price_elo_stats a\
-                                join crypto_db.price_elo_stats b\
-                                on (a.end_time + (60000 * {strongest_minute})) = b.end_time\
-                                where a.coin = '{coin}'\
-                                and b.coin = '{coin}'\
-                                order by a.end_time desc"
-
-            # print(query)
-
-            df = pd.read_sql(query, db)
-
-            if len(df) > 0:
-
-                # print(df)
-
-                x_array = df['x_point_moving_average_deviations'].to_numpy()
-                y_array = df['price_change_percent'].to_numpy()
-                datapoints = x_array.size
-
-                slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x_array, y_array)
-                change_at_3sd = (3 * slope) + intercept
-
-                regplot = sns.regplot(
-                    x=df['x_point_moving_average_deviations'],
-                    y=df['price_change_percent'],
-                    data=df,
-                    line_kws={
-                        'label': "ΔPrice(%) = {0:.2E}*(Elo-μ)/σ + {1:.2E},\nr = {2:.2E}, p = {3:.2E}, @3sd = {4:.2f}%".format(
-                            slope,
-                            intercept,
-                            r_value,
-                            p_value,
-                            change_at_3sd)}
-                )
-                plt.title("{0} at {1} with {2} datapoints".format(coin, timestamp_string, datapoints))
-                plt.xlabel('{0} Point Moving Average Elo Rating Deviations at Time t0'.format(rows))
-                plt.ylabel('Price Change % {0} Minutes After t0 /USDT'.format(strongest_minute))
-                ax.set_xlim(-3, 3)
-                ax.set_ylim(-1.5, 1.5)
-
-                regplot.legend()
-
-                plt.savefig("Charts/Correlations/Correlation_Chart_Test_{1}_Point_Moving_Average_{0}.png".format(coin, rows))
+            try:
+                draw_correlation_chart(coin, *series[coin], strongest_minute, rows, timestamp_string)
+            except Exception as e:
+                log_error(e)
 
         print('Ending stats worker')
 
 
-def read_coin_stats(coin):
-    db = mysql.connector.connect(
-        host=os.environ.get("MYSQL_DATABASE_HOST"),
-        user=os.environ.get("MYSQL_DATABASE_USER"),
-        password=os.environ.get("MYSQL_DATABASE_PASSWORD"),
-        database=os.environ.get("MYSQL_DATABASE_DB")
-    )
+def get_correlation_store():
+    """ Returns the correlation statistics store, loaded again whenever
+    analyse has saved it since it was last read """
+    global correlation_store, correlation_store_mtime
 
-    query = f"  with `a` as (SELECT *, min(`p`) OVER(PARTITION BY `coin`) as `min_p` from `statistics`) \
-                select * from `a`\
-                where `min_p` = `p`\
-                and `coin` = '{coin}'"
+    mtime = os.path.getmtime(STORE_PATH) if os.path.exists(STORE_PATH) else None
+    if correlation_store is None or mtime != correlation_store_mtime:
+        correlation_store = CorrelationStatisticsStore.load()
+        correlation_store_mtime = mtime
 
-    df = pd.read_sql(query, db)
+    return correlation_store
 
-    coin_stats = df.to_dict()
 
-    # print(f"stats for {coin}:", coin_stats)
+def read_coin_stats(coin, moving_average_n=None):
+    """ Returns the CorrelationStatistics of a coin's strongest lag, served
+    from statistics_cache. Coins the database has no statistics for are read
+    from the correlation statistics store, at 'moving_average_n' or at any
+    moving average length if None, but only from rows analyse wrote within
+    the last STATISTICS_MAX_AGE_MINUTES. Older rows, such as those migrated
+    from the pickles, are never traded on and the coin gets all zeroes """
+    coin_stats = statistics_cache.get(coin)
 
-    if len(df) == 0:
-        return cs(coin, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    if coin_stats.timestamp == 0:
+        max_age_millis = MILLIS_IN_MIN * int(os.environ.get("STATISTICS_MAX_AGE_MINUTES", 60 * 24))
+        stored_stats = get_correlation_store().get(coin, moving_average_n=moving_average_n,
+                                                   min_timestamp=int(time.time() * 1000) - max_age_millis)
+        if stored_stats is not None:
+            return stored_stats
 
-    else:
-        return cs(
-            coin=coin_stats['coin'][0],
-            strongest_minute=coin_stats['minutes_forward'][0],
-            slope=coin_stats['slope'][0],
-            intercept=coin_stats['intercept'][0],
-            r_value=coin_stats['r'][0],
-            p_value=coin_stats['p'][0],
-            std_err=coin_stats['std_err'][0],
-            change_at_3sd=coin_stats['change_at_3sd'][0],
-            datapoints=coin_stats['datapoints'][0],
-            timestamp=coin_stats['timestamp'][0]
-        )
+    return coin_stats
 
 
 def get_strongly_correlated_coins():
     constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
     pairs_per_coin_limit = int(constants['pairs_per_coin'])
+    moving_average_n = int(constants['moving_average_n'])
     wanted_coins = binance_api.get_wanted_coins(pairs_per_coin_limit)
 
     strongly_correlated_coins = []
     for wanted_coin in wanted_coins:
         try:
-            if read_coin_stats(wanted_coin).change_at_3sd > 0.1:
-                strongly_correlated_coins.append(read_coin_stats(wanted_coin).coin)
+            coin_stats = read_coin_stats(wanted_coin, moving_average_n)
+            if coin_stats.change_at_3sd > 0.1:
+                strongly_correlated_coins.append(coin_stats.coin)
 
         except Exception as e:
             print(e)
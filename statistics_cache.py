@@ -0,0 +1,119 @@
+import time
+from threading import Lock
+
+from correlation_statistics import CorrelationStatistics
+
+# Row of `statistics` with the lowest p value for each coin
+STRONGEST_STATISTICS_QUERY = "WITH `a` AS (SELECT *, MIN(`p`) OVER (PARTITION BY `coin`) AS `min_p` FROM `statistics`) \
+SELECT `coin`, `minutes_forward`, `slope`, `intercept`, `r`, `p`, `std_err`, `change_at_3sd`, `datapoints`, `timestamp` \
+FROM `a` WHERE `p` = `min_p`"
+
+VERSION_QUERY = "SELECT MAX(`timestamp`), COUNT(*) FROM `statistics`"
+
+
+class StatisticsCache(object):
+    """ In-process cache of the strongest correlation statistics of every coin
+    in `crypto_db`.`statistics`. Once an entry is older than 'ttl' seconds the
+    table's version stamp (latest timestamp and row count) is checked, and only
+    when analyse has written new rows are all coins reloaded, in one query.
+    'connect' returns a new database connection and is only called when there
+    is no open one """
+
+    def __init__(self, connect, ttl=60):
+        self.connect = connect
+        self.ttl = ttl
+        self.lock = Lock()
+        self.db = None
+
+        self.version = None
+        self.checked_at = 0.0
+        # coin -> CorrelationStatistics
+        self.coin_stats = {}
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "version_checks": 0,
+            "reloads": 0
+        }
+
+    def _query(self, query):
+        if self.db is None or not self.db.is_connected():
+            self.db = self.connect()
+            # Each check has to see rows committed since the last one
+            self.db.autocommit = True
+
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(query)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _reload(self):
+        coin_stats = {}
+
+        for row in self._query(STRONGEST_STATISTICS_QUERY):
+            coin = row[0]
+            if coin not in coin_stats:
+                coin_stats[coin] = CorrelationStatistics(
+                    coin=coin,
+                    strongest_minute=row[1],
+                    slope=row[2],
+                    intercept=row[3],
+                    r_value=row[4],
+                    p_value=row[5],
+                    std_err=row[6],
+                    change_at_3sd=row[7],
+                    datapoints=row[8],
+                    timestamp=row[9]
+                )
+
+        self.coin_stats = coin_stats
+        self.stats["reloads"] += 1
+
+    def _validate(self):
+        """ Reloads the statistics if the TTL has expired and the table has
+        changed since they were loaded. Returns True if they were reloaded """
+        if time.time() - self.checked_at < self.ttl:
+            return False
+
+        self.stats["version_checks"] += 1
+        version = tuple(self._query(VERSION_QUERY)[0])
+        self.checked_at = time.time()
+
+        if version == self.version:
+            return False
+
+        self._reload()
+        self.version = version
+        return True
+
+    def get(self, coin):
+        """ Returns the CorrelationStatistics of a coin's strongest lag or all
+        zeroes if the coin has no statistics """
+        with self.lock:
+            if self._validate():
+                self.stats["misses"] += 1
+            else:
+                self.stats["hits"] += 1
+
+            coin_stats = self.coin_stats.get(coin)
+
+        if coin_stats is None:
+            return CorrelationStatistics(coin, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+        return coin_stats
+
+    def invalidate(self):
+        """ Forces a version check on the next lookup """
+        with self.lock:
+            self.checked_at = 0.0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["coins"] = len(self.coin_stats)
+            stats["version"] = self.version
+
+        return stats
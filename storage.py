@@ -0,0 +1,117 @@
+import os
+
+import pymysql
+
+from binanceapi.vol_diff_matrix import VolDiffMatrix
+
+# Columns of the batch tables in the order their rows are written
+VOL_DIFF_FIELDS = ('pair', 'start_time', 'end_time', 'vol_diff')
+ELO_FIELDS = ('coin', 'start_time', 'elo_rating', 'end_time')
+PRICE_FIELDS = ('pair', 'start_time', 'end_time', 'open_price', 'close_price')
+
+
+def get_db_settings():
+    """ Returns the `crypto_db` connection settings from the environment,
+    under the Flask-MySQL config names the server uses """
+    return {
+        'MYSQL_DATABASE_USER': os.environ.get("MYSQL_DATABASE_USER"),
+        'MYSQL_DATABASE_PASSWORD': os.environ.get("MYSQL_DATABASE_PASSWORD"),
+        'MYSQL_DATABASE_DB': os.environ.get("MYSQL_DATABASE_DB"),
+        'MYSQL_DATABASE_HOST': os.environ.get("MYSQL_DATABASE_HOST")
+    }
+
+
+def connect_db():
+    """ Opens a connection to `crypto_db` with the same settings the server
+    uses, for processes writing to it without going through the API """
+    settings = get_db_settings()
+
+    return pymysql.connect(
+        host=settings['MYSQL_DATABASE_HOST'],
+        user=settings['MYSQL_DATABASE_USER'],
+        password=settings['MYSQL_DATABASE_PASSWORD'],
+        database=settings['MYSQL_DATABASE_DB']
+    )
+
+
+def read_vol_diffs(pool, start_time, end_time):
+    """ Returns the rows of `crypto_db`.`vol_diff` starting at or after
+    'start_time' and ending at or before 'end_time' as a VolDiffMatrix """
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT `pair`, `start_time`, `end_time`, `vol_diff` FROM `vol_diff` "
+                           "WHERE `start_time` >= %s AND `end_time` <= %s ORDER BY `end_time`", (start_time, end_time))
+            rows = cursor.fetchall()
+
+    return VolDiffMatrix.from_rows(rows)
+
+
+def get_rows(entries, fields):
+    """ Returns API entries as tuples in 'fields' order """
+    return [tuple(entry[field] for field in fields) for entry in entries]
+
+
+def upsert_rows(pool, table, fields, update_fields, rows, procedures=(), end_times=()):
+    """ Inserts all rows with one multi-row statement in a single
+    transaction. Rows whose unique key (see SQL/UniqueKeys.sql) already exists
+    have their 'update_fields' updated, or are skipped if there are none, so
+    sending the same batch twice is harmless. The derived tables are refreshed
+    for 'end_times' in the same transaction, see refresh_intervals """
+    if len(rows) == 0:
+        return 0
+
+    if len(update_fields) > 0:
+        upsert_query = "INSERT INTO `{0}` ({1}) VALUES ({2}) ON DUPLICATE KEY UPDATE {3}".format(
+            table,
+            ", ".join("`{0}`".format(field) for field in fields),
+            ", ".join(["%s"] * len(fields)),
+            ", ".join("`{0}` = VALUES(`{0}`)".format(field) for field in update_fields))
+    else:
+        upsert_query = "INSERT IGNORE INTO `{0}` ({1}) VALUES ({2})".format(
+            table,
+            ", ".join("`{0}`".format(field) for field in fields),
+            ", ".join(["%s"] * len(fields)))
+
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            try:
+                cursor.executemany(upsert_query, rows)
+                refresh_intervals(cursor, procedures, end_times)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    return len(rows)
+
+
+def refresh_intervals(cursor, procedures, end_times):
+    """ Calls each stored procedure in 'procedures' for every Elo interval
+    end time in 'end_times' to refresh the derived tables
+    `crypto_db`.`elo_stats` (spRefreshEloStats) and `crypto_db`.`price_elo_fact`
+    (spRefreshPriceEloFact). Intervals are refreshed oldest first since each
+    interval's moving averages include the intervals before it """
+    for end_time in sorted(set(end_times)):
+        for procedure in procedures:
+            cursor.callproc(procedure, (end_time,))
+
+
+def store_vol_diffs(pool, rows):
+    """ Upserts VOL_DIFF_FIELDS rows on (`pair`, `end_time`) """
+    return upsert_rows(pool, 'vol_diff', VOL_DIFF_FIELDS, ('start_time', 'vol_diff'), rows)
+
+
+def store_elos(pool, rows):
+    """ Inserts the ELO_FIELDS rows whose (`coin`, `end_time`) is not already
+    in `crypto_db`.`elo` and refreshes the derived tables for their intervals.
+    Ratings already stored are kept """
+    return upsert_rows(pool, 'elo', ELO_FIELDS, (), rows,
+                       ('spRefreshEloStats', 'spRefreshPriceEloFact'), [row[3] for row in rows])
+
+
+def store_prices(pool, rows):
+    """ Upserts PRICE_FIELDS rows on (`pair`, `end_time`) and refreshes the
+    Elo intervals they are matched with """
+    return upsert_rows(pool, 'price', PRICE_FIELDS, ('start_time', 'open_price', 'close_price'), rows,
+                       # Elo intervals end 1ms after the candle they are matched with
+                       ('spRefreshPriceEloFact',), [row[2] + 1 for row in rows])
@@ -0,0 +1,141 @@
+import os
+from threading import Lock
+
+import numpy as np
+
+# Record layout of each kind of series. Every series is sorted by end_time
+SERIES_DTYPES = {
+    'price': np.dtype([
+        ('end_time', np.int64),
+        ('start_time', np.int64),
+        ('open_price', np.float64),
+        ('close_price', np.float64)
+    ]),
+    'vol_diff': np.dtype([
+        ('end_time', np.int64),
+        ('start_time', np.int64),
+        ('vol_diff', np.float64)
+    ]),
+    'elo': np.dtype([
+        ('end_time', np.int64),
+        ('start_time', np.int64),
+        ('elo_rating', np.float64)
+    ])
+}
+
+# Field of the API entries naming the series they belong to
+SERIES_KEYS = {
+    'price': 'pair',
+    'vol_diff': 'pair',
+    'elo': 'coin'
+}
+
+STORE_ROOT = "Time_Series"
+
+
+class TimeSeriesStore(object):
+    """ Append-only local copy of the price, vol_diff and Elo history. Each
+    series (a pair's prices or vol_diffs, a coin's Elo ratings) is a file of
+    fixed-width records (see SERIES_DTYPES) under '<root>/<kind>/<key>.dat'.
+    Reads memory-map the file and return a time range of it as a view, so
+    bulk analytics don't go through SQL and the JSON API.
+    Records are only appended if they end after the last stored record, which
+    keeps each file sorted and makes re-sending a batch harmless, and a record
+    ending at the same time as the last stored one replaces it, so a candle
+    fetched again once closed updates the one stored while it was open. Every
+    kind is meant to be written by a single process, the storage_worker, so
+    the store only covers the history collected live since it started.
+    Older records, such as those backfill loads into SQL, are not stored """
+
+    def __init__(self, root=STORE_ROOT):
+        self.root = root
+        self.lock = Lock()
+
+    def get_path(self, kind, key):
+        return os.path.join(self.root, kind, "{0}.dat".format(key))
+
+    def get_keys(self, kind):
+        """ Returns the pairs or coins with a stored series of 'kind' """
+        directory = os.path.join(self.root, kind)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(file_name[:-4] for file_name in os.listdir(directory) if file_name.endswith(".dat"))
+
+    def open(self, kind, key):
+        """ Returns the whole series as a read-only memory-mapped structured
+        array, empty if nothing is stored """
+        dtype = SERIES_DTYPES[kind]
+        path = self.get_path(kind, key)
+
+        # A record cut short by a crash mid-append is ignored
+        count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    def read(self, kind, key, start_time=None, end_time=None):
+        """ Returns a view of the records with start_time <= end_time <=
+        end_time, either bound may be None """
+        series = self.open(kind, key)
+        end_times = series['end_time']
+
+        start = 0 if start_time is None else np.searchsorted(end_times, start_time, side='left')
+        stop = len(series) if end_time is None else np.searchsorted(end_times, end_time, side='right')
+
+        return series[start:stop]
+
+    def get_last_end_time(self, kind, key):
+        series = self.open(kind, key)
+        return int(series['end_time'][-1]) if len(series) > 0 else None
+
+    def append(self, kind, key, records):
+        """ Appends the structured 'records' ending after the last stored
+        record, replaces the last stored record with the one ending at the same
+        time and returns how many records were written. Of several records with
+        the same end_time the last one is kept """
+        dtype = SERIES_DTYPES[kind]
+        records = np.asarray(records, dtype=dtype)[::-1]
+        _, last_index = np.unique(records['end_time'], return_index=True)
+        records = records[last_index]
+        path = self.get_path(kind, key)
+
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            last_end_time = self.get_last_end_time(kind, key)
+            replacement = records[:0]
+            if last_end_time is not None:
+                replacement = records[records['end_time'] == last_end_time]
+                records = records[records['end_time'] > last_end_time]
+
+            if len(replacement) + len(records) == 0:
+                return 0
+
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+                # Drop any partial record left by an interrupted append
+                file.truncate((os.path.getsize(path) // dtype.itemsize) * dtype.itemsize)
+
+                if len(replacement) > 0:
+                    file.seek(-dtype.itemsize, os.SEEK_END)
+                    file.write(replacement.tobytes())
+
+                file.seek(0, os.SEEK_END)
+                file.write(records.tobytes())
+
+        return len(replacement) + len(records)
+
+    def append_entries(self, kind, entries):
+        """ Appends API entries (the dictionaries posted to the Price, VolDiff
+        and Elo endpoints) to the series named by their pair or coin and
+        returns how many records were written """
+        dtype = SERIES_DTYPES[kind]
+        key_field = SERIES_KEYS[kind]
+
+        series = {}
+        for entry in entries:
+            series.setdefault(entry[key_field], []).append(
+                tuple(dtype[name].type(entry[name]) for name in dtype.names))
+
+        return sum(self.append(kind, key, np.array(rows, dtype=dtype)) for key, rows in series.items())
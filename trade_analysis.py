@@ -15,6 +15,7 @@ import binanceapi.spot_extended
 import statistical_analysis as sa
 import urls as u
 from binanceapi.constant import Interval
+from timeseries_store import TimeSeriesStore
 
 
 def calculate_percent_change(df, row, column):
@@ -35,9 +36,28 @@ def calculate_percent_change(df, row, column):
             return 0.0
 
 
+def get_usd_price(base_asset, trade_time):
+    """ Returns the USDT close price of the candle ending in the minute
+    before 'trade_time', from the local time series store if it has one and
+    from the kline cache otherwise """
+    prices = time_series_store.read('price', f"{base_asset}-USDT", trade_time - (60 * 1000), trade_time)
+
+    if len(prices) > 0:
+        return prices['close_price'][-1]
+
+    # Klines are selected by open time, so the candle closing in the same
+    # minute as above opens up to two minutes before the trade
+    kline = binance_api.kline_cache.get_klines(f"{base_asset}USDT", Interval.MINUTE_1, trade_time - (2 * 60 * 1000),
+                                               trade_time)
+    closed = kline[(kline['close_time'] >= trade_time - (60 * 1000)) & (kline['close_time'] <= trade_time)]
+
+    return closed['close'].iloc[-1]
+
+
 load_dotenv()
 
 cg = CoinGeckoAPI()
+time_series_store = TimeSeriesStore()
 
 # Binance configurations
 binance_key = os.environ.get("BINANCE_KEY")
@@ -95,9 +115,7 @@ df = df.reset_index()
 pair_symbol_dict = sa.create_pair_symbol_dict()
 df['pair'] = df.apply(lambda row: sa.convert_symbol_to_pair(df.loc[row.name, 'symbol'], pair_symbol_dict), axis=1)
 df['baseAsset'] = df.apply(lambda row: df.loc[row.name, 'pair'][:df.loc[row.name, 'pair'].find("-")], axis=1)
-df['priceUsd'] = df.apply(lambda row: binance_api.get_kline(f"{df.loc[row.name, 'baseAsset']}USDT", Interval.MINUTE_1,
-                                                            df.loc[row.name, 'time'] - (60 * 1000),
-                                                            df.loc[row.name, 'time'])[0][4], axis=1)
+df['priceUsd'] = df.apply(lambda row: get_usd_price(df.loc[row.name, 'baseAsset'], int(df.loc[row.name, 'time'])), axis=1)
 df['valueUsd'] = df.apply(lambda row: float(df.loc[row.name, 'origQty']) * float(df.loc[row.name, 'priceUsd']), axis=1)
 df['date'] = df.apply(
     lambda row: datetime.datetime.strftime(datetime.datetime.fromtimestamp(int(df.loc[row.name, 'time']) / 1000),
@@ -18,9 +18,14 @@ class Urls(object):
 
         # Define urls
         self.ELO = f"{base_url}/Elo"
+        self.ELO_BATCH = f"{base_url}/Elo/Batch"
         self.ELO_STATS = f"{base_url}/EloStats"
         self.CONSTANTS = f"{base_url}/Constants"
         self.VOL_DIFF = f"{base_url}/VolDiff"
+        self.VOL_DIFF_BATCH = f"{base_url}/VolDiff/Batch"
+        self.VOL_DIFF_MATRIX = f"{base_url}/VolDiff/Matrix"
         self.PRICE = f"{base_url}/Price"
+        self.PRICE_BATCH = f"{base_url}/Price/Batch"
         self.PRICE_STATS = f"{base_url}/PriceStats"
         self.STATISTICS = f"{base_url}/Statistics"
+        self.STATISTICS_BATCH = f"{base_url}/Statistics/Batch"
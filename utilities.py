@@ -1,7 +1,9 @@
 import csv
 import datetime
 import logging
+import os
 import pickle
+from contextlib import contextmanager
 
 from binanceapi.constant import OrderSide, OrderType
 
@@ -62,3 +64,14 @@ def log_error(error_message):
                         format='%(asctime)s %(message)s',
                         datefmt='%Y-%m-%d %Hh-%Mm-%Ss')
     logging.debug(f"{error_message}\n")
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """ Opens a temporary file next to 'path' for writing and moves it over
+    'path' once it is closed, so a crash never leaves a truncated file behind.
+    If writing fails 'path' is left as it was """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, mode) as file:
+        yield file
+    os.replace(temporary_path, path)
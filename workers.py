@@ -1,29 +1,49 @@
 import multiprocessing as mp
+import os
 import socket
 import time
 
-import numpy as np
 import requests
 import simplejson
 
-import elo
+import elo_engine
+import storage
 import urls as u
 from binanceapi import spot_extended
 from binanceapi.constant import Interval
+from binanceapi.rate_limiter import RateLimiter
+from binanceapi.vol_diff_matrix import VolDiffMatrix
+from db_pool import ConnectionPool
 from statistical_analysis import get_strongly_correlated_coins, read_coin_stats
-from utilities import log_error
+from timeseries_store import TimeSeriesStore
+from utilities import atomic_write, log_error
 
+MILLIS_IN_MIN = 1000 * 60
 
-def bot_worker(binance_key, binance_secret):
+# Attempts at writing a batch before the storage_worker gives up on it for now
+STORAGE_ATTEMPTS = 3
+
+
+def append_time_series(time_series_store, kind, entries):
+    """ Copies entries written to SQL into the local time series store. A
+    failure here is logged without affecting the SQL copy """
+    try:
+        time_series_store.append_entries(kind, entries)
+    except Exception as e:
+        log_error(e)
+        print("Error appending {0} to time series store: {1}".format(kind, e))
+
+
+def bot_worker(binance_key, binance_secret, rate_limiter=None, urls=None):
     """ Gets the current coin from Binance i.e. the one with the most value and
         checks if its value against USDT has increased by x% since either the time
         it was bought or 5 minutes before the bot was started. If it has
         increased by x% then the bot sells it back into USDT. USDT is used in this
         sense because it is a likely fiat currency to ultimately withdraw into.
         The Elo rating of each coin in the SQL table `crypto`.`db`.`elo` (posted by
-        the elo_worker) is taken via the `crypto_db`.`elo_stats` view. This view
-        takes the data for each interval in the `crypto`.`db`.`elo` table, averages
-        it across the entire interval, calculates the standard deviation across each
+        the elo_worker) is taken via the `crypto_db`.`elo_stats` table. This table
+        is refreshed for each interval posted to the `crypto`.`db`.`elo` table, it
+        averages the interval, calculates the standard deviation across each
         interval and then calculates the upper and lower limits using the standard
         deviation multiplied by a constant (defined in the constants table) as
         explained in the elo_worker.
@@ -35,10 +55,13 @@ def bot_worker(binance_key, binance_secret):
         described above """
 
     # Instantiate Binance api
-    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
+    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret,
+                                                        rate_limiter=rate_limiter)
+
+    symbols = binance_api.get_symbols()
 
-    symbol_dicts = binance_api.get_exchange_info()['symbols']
-    symbols = [symbol_dict['symbol'] for symbol_dict in symbol_dicts]
+    if urls is None:
+        urls = get_urls()
 
     while True:
         # Loops every y minutes to get the current_coin and Elo data then check
@@ -50,11 +73,6 @@ def bot_worker(binance_key, binance_secret):
         try:
             print("Starting bot worker")
 
-            # Get the ip address
-            h_name = socket.gethostname()
-            host = str(socket.gethostbyname(h_name))
-            urls = u.Urls(host=host)
-
             # Get a list of only the coins which have a good statistical correlation
             strongly_correlated_coins = get_strongly_correlated_coins()
 
@@ -146,12 +164,12 @@ def bot_worker(binance_key, binance_secret):
                             try:
                                 end_time = int(trade_time)
                                 start_time = int(trade_time - (60 * 1000))
-                                initial_coin_usdt_price = float(binance_api.get_kline(
+                                initial_coin_usdt_price = float(binance_api.kline_cache.get_klines(
                                     symbol="{0}USDT".format(coin),
                                     interval=Interval.MINUTE_1,
                                     end_time=end_time,
                                     start_time=start_time
-                                )[0][4])
+                                )['close'].iloc[0])
                                 coin_usdt_price = float(binance_api.get_latest_price("{0}USDT".format(coin))['price'])
                                 coin_price_percent_change = (100 * coin_usdt_price / initial_coin_usdt_price) - 100
                             except Exception as e:
@@ -236,11 +254,6 @@ def bot_worker(binance_key, binance_secret):
             log_error(e)
             print("Error in bot worker: {0}".format(e))
 
-        # Get the ip address
-        h_name = socket.gethostname()
-        host = str(socket.gethostbyname(h_name))
-        urls = u.Urls(host=host)
-
         # Gets constants each loop so it can be editted live
         constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
         time.sleep(60 * (constants['minutes']))
@@ -248,14 +261,87 @@ def bot_worker(binance_key, binance_secret):
         print("Ending bot worker")
 
 
-def elo_worker(binance_key, binance_secret):
+def vol_diff_worker(binance_key, binance_secret, rate_limiter, urls, vol_diff_queue, storage_queue):
     """ Takes the trade volume data for each pair in the 'wanted_coins list'.
         Pairs are calculated by concatenating every coin in the list against every
         other coin. Volume difference is calculated by comparing the volumes traded
         in each pair. The get_vol_diffs method calculates this for the time between
         *now* and y minutes ago with interval of z minutes (usually will be the
-        same as y). This data is then posted to the SQL table
-        `crypto`.`db`.`vol_diff`.
+        same as y). Each batch is handed to the elo_worker through
+        'vol_diff_queue' and to the storage_worker, which writes it to the SQL
+        table `crypto`.`db`.`vol_diff`, through 'storage_queue' """
+
+    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret,
+                                                        rate_limiter=rate_limiter)
+
+    while True:
+        print("Starting vol_diff worker")
+        # Loop every y minutes to gather vol_diff data
+
+        # Gets constants each loop so it can be editted live
+        constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
+        minutes = constants['minutes']
+        pairs_per_coin_limit = constants['pairs_per_coin']
+
+        try:
+            # Get the volume differences for each pair
+            vol_diffs = binance_api.get_vol_diffs(minutes, minutes, pairs_per_coin_limit).to_matrix()
+
+            # The batch goes straight to the Elo computation rather than being
+            # read back from the table
+            vol_diff_queue.put(vol_diffs)
+            storage_queue.put(('vol_diff', vol_diffs))
+
+        except Exception as e:
+            log_error(e)
+            print("Error in vol_diff worker: {0}".format(e))
+
+        time.sleep(60 * minutes)
+
+        print("Ending vol_diff worker")
+
+
+def record_window(window):
+    """ Saves the window of vol_diffs the elo_worker rated last, the input
+    elo_engine.check_parity is run on. A failure here is logged without
+    affecting the ratings """
+    try:
+        os.makedirs(os.path.dirname(elo_engine.RECORDING_PATH), exist_ok=True)
+        with atomic_write(elo_engine.RECORDING_PATH, "wb") as file:
+            window.save(file)
+    except Exception as e:
+        log_error(e)
+        print("Error recording Elo window: {0}".format(e))
+
+
+def rate_vol_diffs(pool, vol_diffs, elo_state, rater="legacy", step_millis=None):
+    """ Returns the Elo entries after the checkpoint in 'elo_state' of the
+    vol_diffs in `crypto_db`.`vol_diff` and 'vol_diffs' (a VolDiffMatrix, the
+    batch may not have been written yet), rated in windows of
+    elo_engine.WINDOW_MILLIS from the initial ratings by elo.get_elos, or the
+    engine if 'rater' is 'engine'. Usually this is the one window ending now,
+    the last hour of vol_diffs the worker has always rated, so a cycle costs
+    the same whatever the size of the table. If the checkpoint is further
+    back, because the worker was stopped or ratings were not stored, the
+    intervals since are caught up with one window every 'step_millis' (a
+    cycle), see elo_engine.rate_windows """
+    now = int(time.time() * 1000)
+    window_end_time = max([now - now % MILLIS_IN_MIN] + vol_diffs.end_times.tolist())
+
+    window_end_times = [window_end_time]
+    if elo_state.end_time is not None and step_millis:
+        window_end_times = list(range(elo_state.end_time + step_millis, window_end_time, step_millis)) + window_end_times
+
+    history = storage.read_vol_diffs(pool, window_end_times[0] - elo_engine.WINDOW_MILLIS, window_end_time)
+    history = VolDiffMatrix.from_rows(history.to_rows() + vol_diffs.to_rows())
+
+    record_window(history.select_between(window_end_time - elo_engine.WINDOW_MILLIS, window_end_time))
+
+    return elo_state.get_new_elos(elo_engine.rate_windows(history, window_end_times, rater))
+
+
+def elo_worker(urls, vol_diff_queue, storage_queue, elo_ack_queue):
+    """ Rates every batch of volume differences the vol_diff_worker collects.
         A higher volume than the other coin means higher popularity
         meaning that this coin effectively 'won' the pair while the other coin
         'lost'. It is possible to then apply a 1v1 gaming rating to this result,
@@ -274,112 +360,67 @@ def elo_worker(binance_key, binance_secret):
         simultaneously also gives us the insight into the whole system of
         cryptocurrencies rather than a single pair like with most trading
         indicators. The Elo rating for each coin at each interval is calculated in
-        the get_elos method and posted to the SQL table `crypto`.`db`.`elo` """
-
-    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
-
-    # Instantiate Elo class object
-    _elo = elo
+        the get_elos method (see rate_vol_diffs) and handed to the storage_worker
+        to be written to the SQL table `crypto`.`db`.`elo`. The checkpoint only
+        moves on once the storage_worker confirms on 'elo_ack_queue' that the
+        ratings are stored, otherwise they are rated again with the next batch.
+        ELO_RATER=engine rates with elo_engine instead of elo.get_elos, which
+        should only be set once elo_engine.check_parity passes """
+
+    # Ratings of every coin at the last interval rated, kept across restarts
+    elo_state = elo_engine.EloState.load()
+    rater = os.environ.get("ELO_RATER", "legacy")
+    pool = ConnectionPool(storage.connect_db, size=1)
+
+    # The first cycle rates only what is in the table, catching up on the
+    # intervals stored while the worker was not running
+    vol_diffs = VolDiffMatrix.empty()
 
     while True:
-        print("Starting elo worker")
-        # Loop every y minutes to gather vol_diff data then apply elo ratings,
-        # then posts this to SQL
-
-        # Get the ip address
-        h_name = socket.gethostname()
-        host = str(socket.gethostbyname(h_name))
-        urls = u.Urls(host=host)
-
-        # Gets constants each loop so it can be editted live
-        constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
-        minutes = constants['minutes']
-        pairs_per_coin_limit = constants['pairs_per_coin']
-
         try:
-            # Get the volume differences for each pair
-            vol_diffs = binance_api.get_vol_diffs(minutes, minutes, pairs_per_coin_limit)
-
-            # Put data in table
-            for vol_diff_entry in vol_diffs:
-                requests.post(url=urls.VOL_DIFF, data=vol_diff_entry)
-
-            # Retrieve the data back
-            all_vol_diffs = simplejson.loads(requests.get(
-                url=urls.VOL_DIFF,
-                # params = {"start_time": start_time, "end_time": end_time}
-            ).text)
-
-            # If there is data then calculate Elo ratings
-            if len(all_vol_diffs) > 0:
-                # Pair dict is just a legacy method of calculating Elo ratings, don't want to touch as it works
-                pair_dict = binance_api.convert_vol_diffs_to_pair_dict(all_vol_diffs)
-                elos = _elo.get_elos(pair_dict)
-
-                # Retrieve all Elo data
-                all_elos = simplejson.loads(requests.get(
-                    url=urls.ELO
-                ).text)
-
-                elo_coin_time_dict = {}
-
-                # Build dictionary containing all the coin:end_times
-                for elo_entry in all_elos:
-                    elo_coin = elo_entry['coin']
-                    elo_end_time = elo_entry['end_time']
-
-                    if elo_coin not in elo_coin_time_dict:
-                        elo_coin_time_dict[elo_coin] = np.array([])
-
-                    elo_coin_time_dict[elo_coin] = np.append(elo_coin_time_dict[elo_coin], elo_end_time)
+            print("Starting elo worker")
+            # Gets constants each loop so it can be editted live
+            constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
+            step_millis = MILLIS_IN_MIN * int(constants['minutes'])
 
-                # Check if coin end_time is already in table and if it isn't, post it
-                for elo_entry in elos:
-                    new_elo_coin = elo_entry['coin']
-                    new_elo_end_time = elo_entry['end_time']
+            elos = rate_vol_diffs(pool, vol_diffs, elo_state, rater, step_millis)
 
-                    try:
-                        if (len(np.where(elo_coin_time_dict[new_elo_coin] == new_elo_end_time)[0]) == 0) or (
-                                new_elo_coin not in elo_coin_time_dict):
-                            # This end_time for this coin is not in the table so post it into table
-                            requests.post(
-                                url=urls.ELO,
-                                data=elo_entry)
+            if len(elos) > 0:
+                # The table ignores coin:end_times it already holds so every
+                # rating can be stored without checking what is there
+                storage_queue.put(('elo', elos))
 
-                    except Exception as e:
-                        print(e)
-                        log_error(e)
-                        requests.post(
-                            url=urls.ELO,
-                            data=elo_entry)
+                # Only moved on once the ratings are stored
+                if elo_ack_queue.get():
+                    elo_state.update(elos)
+                    elo_state.save()
+                else:
+                    print("Elo ratings were not stored, the checkpoint stays at {0}".format(elo_state.end_time))
 
         except Exception as e:
             log_error(e)
             print("Error in elo worker: {0}".format(e))
 
-        time.sleep(60 * minutes)
-
         print("Ending elo worker")
 
+        # Blocks until the vol_diff_worker has a new batch
+        vol_diffs = vol_diff_queue.get()
 
-def price_worker(binance_key, binance_secret):
+
+def price_worker(binance_key, binance_secret, rate_limiter, urls, storage_queue):
     """ Takes the prices for each coin in the 'wanted_coins list' against
     a base asset. Only gets the prices from *now* to y minutes
     ago where y is the second argument in the method get_prices. The third
     argument is the interval to break the price response up into between the
-    date ranges. Once the price data has been received, this worker then posts
-    them to the SQL database `crypto`.`db`.`price` and waits y minutes before
-    looping """
+    date ranges. Once the price data has been received, this worker hands them
+    to the storage_worker to be written to the SQL database
+    `crypto`.`db`.`price` and waits y minutes before looping """
 
-    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret)
+    binance_api = spot_extended.BinanceSpotExtendedHttp(api_key=binance_key, secret=binance_secret,
+                                                        rate_limiter=rate_limiter)
 
     while True:
-        # Loops every y minutes to get price data from binance then post to SQL
-
-        # Get the ip address
-        h_name = socket.gethostname()
-        host = str(socket.gethostbyname(h_name))
-        urls = u.Urls(host=host)
+        # Loops every y minutes to get price data from binance then store it
 
         # Gets constants each loop so it can be editted live
         constants = simplejson.loads(requests.get(url=urls.CONSTANTS).text)
@@ -392,59 +433,107 @@ def price_worker(binance_key, binance_secret):
             # Calculate prices for all coins against base
             prices = binance_api.get_prices("USDT", minutes, minutes, pairs_per_coin_limit)
 
-            # Retrieve all price data
-            all_prices = simplejson.loads(requests.get(
-                url=urls.PRICE
-            ).text)
+            # Pair:end_times already in the table are updated rather than
+            # duplicated so there is no need to download the table first
+            storage_queue.put(('price', list(prices)))
 
-            price_pair_time_dict = {}
+        except Exception as e:
+            log_error(e)
+            print("Error in price worker: {0}".format(e))
 
-            # Build dictionary containing all the pair:end_times
-            for price_entry in all_prices:
-                price_pair = price_entry['pair']
-                price_end_time = price_entry['end_time']
+        time.sleep(60 * minutes)
 
-                if price_pair not in price_pair_time_dict:
-                    price_pair_time_dict[price_pair] = np.array([])
+        print("Ending price worker")
 
-                price_pair_time_dict[price_pair] = np.append(price_pair_time_dict[price_pair], price_end_time)
 
-            # Check if pair end_time is already in table and if it isn't, post it
-            for price_entry in prices:
-                new_price_pair = price_entry['pair']
-                new_price_end_time = price_entry['end_time']
+def store_batch(pool, kind, batch):
+    """ Writes one storage_queue batch to SQL and returns its API entries and
+    the number of rows written """
+    if kind == 'vol_diff':
+        return batch.to_entries(), storage.store_vol_diffs(pool, batch.to_rows())
+    elif kind == 'elo':
+        return batch, storage.store_elos(pool, storage.get_rows(batch, storage.ELO_FIELDS))
+    else:
+        return batch, storage.store_prices(pool, storage.get_rows(batch, storage.PRICE_FIELDS))
+
+
+def storage_worker(storage_queue, elo_ack_queue):
+    """ Writes the batches the other workers put on 'storage_queue' to SQL,
+    straight through a connection pool rather than the HTTP API, and copies
+    them to the local time series store. Items are (kind, batch) tuples where
+    kind is 'vol_diff' (a VolDiffMatrix), 'elo' or 'price' (lists of API
+    entries). A batch which fails STORAGE_ATTEMPTS times in a row is put back
+    on the queue, except Elo ratings which are rated again instead. Whether
+    each 'elo' batch was stored is put on 'elo_ack_queue' for the elo_worker's
+    checkpoint. Being the only process writing the batch
+    tables and the time series store keeps the collectors from waiting on the
+    database """
+
+    pool = ConnectionPool(storage.connect_db, size=1)
+    time_series_store = TimeSeriesStore()
 
-                try:
+    while True:
+        kind, batch = storage_queue.get()
 
-                    if (len(np.where(price_pair_time_dict[new_price_pair] == new_price_end_time)[0]) == 0) or (
-                            new_price_pair not in price_pair_time_dict):
-                        # This end_time for this pair is not in the table so post it into table
-                        requests.post(
-                            url=urls.PRICE,
-                            data=price_entry)
+        for attempt in range(STORAGE_ATTEMPTS):
+            try:
+                entries, count = store_batch(pool, kind, batch)
+                print("Stored {0} {1} entries".format(count, kind))
+                break
 
-                except Exception as e:
-                    print(e)
-                    log_error(e)
-                    requests.post(
-                        url=urls.PRICE,
-                        data=price_entry)
+            except Exception as e:
+                log_error(e)
+                print("Error storing {0} (attempt {1} of {2}): {3}".format(kind, attempt + 1, STORAGE_ATTEMPTS, e))
 
-        except Exception as e:
-            log_error(e)
-            print("Error in price worker: {0}".format(e))
+                if attempt + 1 < STORAGE_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+        else:
+            if kind == 'elo':
+                # The elo_worker rates these intervals again with its next batch
+                elo_ack_queue.put(False)
+            else:
+                # Retried after the batches queued since, the upserts make
+                # storing it late or twice harmless
+                storage_queue.put((kind, batch))
+            continue
 
-        time.sleep(60 * minutes)
+        if kind == 'elo':
+            elo_ack_queue.put(True)
 
-        print("Ending price worker")
+        append_time_series(time_series_store, kind, entries)
+
+
+def get_urls():
+    """ Returns the urls of the API server running on this machine """
+    h_name = socket.gethostname()
+    host = str(socket.gethostbyname(h_name))
+
+    return u.Urls(host=host)
 
 
 def multiprocess_workers(binance_key, binance_secret):
     if __name__ == 'workers':
-        p1 = mp.Process(target=elo_worker, args=(binance_key, binance_secret))
-        p2 = mp.Process(target=price_worker, args=(binance_key, binance_secret))
-        p3 = mp.Process(target=bot_worker, args=(binance_key, binance_secret))
+        # One request weight budget shared by all the collectors
+        rate_limiter = RateLimiter()
+
+        # The host is resolved once for every worker
+        urls = get_urls()
+
+        # Collected batches flow between the processes through queues, the
+        # API is only read for the constants and Elo stats
+        vol_diff_queue = mp.Queue()
+        storage_queue = mp.Queue()
+        elo_ack_queue = mp.Queue()
+
+        p1 = mp.Process(target=vol_diff_worker, args=(binance_key, binance_secret, rate_limiter, urls,
+                                                      vol_diff_queue, storage_queue))
+        p2 = mp.Process(target=elo_worker, args=(urls, vol_diff_queue, storage_queue, elo_ack_queue))
+        p3 = mp.Process(target=price_worker, args=(binance_key, binance_secret, rate_limiter, urls, storage_queue))
+        p4 = mp.Process(target=storage_worker, args=(storage_queue, elo_ack_queue))
+        p5 = mp.Process(target=bot_worker, args=(binance_key, binance_secret, rate_limiter, urls))
 
         p1.start()
         p2.start()
         p3.start()
+        p4.start()
+        p5.start()